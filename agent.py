@@ -1,7 +1,6 @@
 import numpy as np
 
 from cards import Bid, Card, Hand
-from util import get_first_card
 
 
 class AgentBase:
@@ -27,10 +26,11 @@ class AgentBase:
         """
         pass
 
-    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken):
+    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken, legal_plays):
         """
         Returns the card to play as a (1, 52) one-hot vector where the index represents the card
         and removes the card from the player's hand
+        legal_plays is the bitboard of the cards in the hand that may be played (see Hand.legal_plays)
         """
         pass
 
@@ -55,14 +55,10 @@ class DummyAgent(AgentBase):
     def get_bid(self, bid_state):
         return Bid(3)
     
-    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken):
-        # if we don't need to match suit, play the first card
-        if turn_index == 0 or not self.hand.has_suit(turn_cards[starting_index].suit()):
-            return self.hand.play_card(self.hand[0])
-
-        # if we need to match suit, play first card that is valid suit
+    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken, legal_plays):
+        # the hand is sorted, so the first legal card is the lowest
         for card in self.hand.cards:
-            if card.suit() == turn_cards[starting_index].suit():
+            if card.bit & legal_plays:
                 return self.hand.play_card(card)
 
 
@@ -75,11 +71,10 @@ class GreedyAgent(AgentBase):
     def get_bid(self, bid_state):
         return Bid(3)
     
-    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken):
-        first_card = get_first_card(turn_cards, turn_index, starting_index)
-        # select the highest probability card that is a valid play
-        for card in self.hand.cards[::-1]:
-            if card.is_valid_play(self.hand, spades_broken, first_card):
+    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken, legal_plays):
+        # the hand is sorted, so the last legal card is the highest
+        for card in reversed(self.hand.cards):
+            if card.bit & legal_plays:
                 return self.hand.play_card(card)
 
 
@@ -108,7 +103,7 @@ class UserAgent(AgentBase):
         print()
         return Bid(bid_num)
 
-    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken):
+    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken, legal_plays):
         print(f'You are player {self.player_id} with turn {turn_index} in the round')
         print('Current scores:')
         print(scores[-1])
@@ -121,8 +116,7 @@ class UserAgent(AgentBase):
         print('Your hand:')
         print(self.hand)
         play_index = int(input('Enter index of card to play: '))
-        first_card = get_first_card(turn_cards, turn_index, starting_index)
-        while play_index < 0 or play_index > len(self.hand) or not self.hand[play_index].is_valid_play(self.hand, spades_broken, first_card, check_hand=True):
+        while play_index < 0 or play_index >= len(self.hand) or not self.hand[play_index].bit & legal_plays:
             print('Play must be in your hand and valid according to the rules')
             play_index = int(input('Enter index of card to play: '))
         print()
@@ -1,13 +1,21 @@
 import os
+import time
+import contextlib
 import ujson
 import numpy as np
-import queue
-import multiprocessing
 
 from agent import AgentBase, TrainedAgent
 from cards import Bid, Card, Hand
-from util import get_first_card, get_first_one_2d, logger
-from spades import Spades, multiprocess_spades_game
+from util import as_seed_sequence, get_first_one_2d, get_logger
+from spades import Spades, GamePool, ResultDetail
+from batch_spades import play_policy_games
+from fitness import FitnessAggregator, racing_schedule
+from checkpoint import CheckpointStore, CheckpointWriter, load_training_state, save_training_state
+from records import GAME_RECORDS_FOLDER
+from ai_agents.population import SharedPopulation, init_population_worker, population_spades_game
+
+
+logger = get_logger('training')
 
 
 class ConstantWeightsGenetic(TrainedAgent):
@@ -20,14 +28,17 @@ class ConstantWeightsGenetic(TrainedAgent):
     and the remaining (N - X) are replenished through crossover of the weights of the X best.
     """
 
-    def __init__(self,  bid_weights=None, play_weights=None, bid_weights_file: str = None, play_weights_file: str = None):
+    DEFAULT_BID_WEIGHTS = np.array([[0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=float)  # force 3 bid every time
+
+    def __init__(self,  bid_weights=None, play_weights=None, bid_weights_file: str = None, play_weights_file: str = None, rng=None):
         """
         Prioritizes passed in weight arrays over filename strings
+        rng is the Generator used for any randomly initialized weights
         """
         super().__init__()
 
-        self.rng = np.random.default_rng()
-        self.win_count = 0  # used for genetic evolution training algorithm
+        if rng is None:
+            rng = np.random.default_rng()
 
         if bid_weights is not None:
             self.bid_weights = bid_weights
@@ -36,8 +47,8 @@ class ConstantWeightsGenetic(TrainedAgent):
             if self.bid_weights.shape != (1, Bid.BID_LEN):
                 raise AttributeError(f"bid weights file must encode a (1, {Bid.BID_LEN}) array")
         else:
-            # self.bid_weights = self.rng.random((1, Bid.BID_LEN))
-            self.bid_weights = np.array([[0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]])  # force 3 bid every time
+            # self.bid_weights = rng.random((1, Bid.BID_LEN))
+            self.bid_weights = self.DEFAULT_BID_WEIGHTS.copy()
 
         if play_weights is not None:
             self.play_weights = play_weights
@@ -46,7 +57,7 @@ class ConstantWeightsGenetic(TrainedAgent):
             if self.play_weights.shape != (1, Card.CARD_LEN):
                 raise AttributeError(f"play weights file must encode a (1, {Card.CARD_LEN}) array")
         else:
-            self.play_weights = self.rng.random((1, Card.CARD_LEN))
+            self.play_weights = rng.random((1, Card.CARD_LEN))
 
         # make sure no weights are zero, or infinite loops could happen when using argmax
         for i in np.where(self.bid_weights[0] == 0)[0]:
@@ -56,41 +67,87 @@ class ConstantWeightsGenetic(TrainedAgent):
         
         # disable NIL bid
         self.bid_weights[0, 0] = 0
-        
+
+        self.precompute_decisions()
+
+    def precompute_decisions(self):
+        """
+        The weights never change while the agent plays, so its bid and its order of preference over the cards are fixed;
+        both are worked out once here, and later changes to the weight arrays do not affect the agent
+        Ties keep the lowest index first, as argmax does
+        """
+        self.bid = Bid(int(np.argmax(self.bid_weights)))
+        self.play_order = [Spades.CARD_BANK[value] for value in np.argsort(-self.play_weights[0], kind='stable')]
+
+    def __getstate__(self):
+        # the precomputed decisions are rebuilt on unpickling rather than sent to the workers
+        state = self.__dict__.copy()
+        del state['bid'], state['play_order']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.precompute_decisions()
 
     def get_bid(self, bid_state):
         """
         Chooses the largest weight preference
         """
-        bid_num = np.argmax(self.bid_weights)
-
-        return Bid(bid_num)
+        return self.bid
 
-    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken):
+    def get_play(self, turn_index, bids, scores, previous_play, turn_cards, starting_index, spades_broken, legal_plays):
         """
         Returns the card to play as a (1, 52) one-hot vector where the index represents the card
         and removes the card from the player's hand
         """
-        first_card = get_first_card(turn_cards, turn_index, starting_index)
-
-        choice_weights = self.play_weights.copy()
-        max_index = np.argmax(choice_weights)
-        play_card = Spades.CARD_BANK[max_index]
-        # select the highest probability card that is a valid play
-        while not play_card.is_valid_play(self.hand, spades_broken, first_card, check_hand=True):
-            choice_weights[0, max_index] = 0
-            max_index = np.argmax(choice_weights)
-            play_card = Spades.CARD_BANK[max_index]
-
-        return self.hand.play_card(play_card)
+        # play the most preferred card that is a valid play
+        for card in self.play_order:
+            if card.bit & legal_plays:
+                return self.hand.play_card(card)
 
 
     @classmethod
     def train(cls, population_size: int = 64, select_number: int = 8, games_per_gen: int = 100, num_generations: int = 1000, num_validation_games: int = 100,
-              mutate_threshold: float = 0.1, perturb_mult: float = 0.1, max_rounds: int = 25, output_folder: str = 'output', core_count: int = 4):
+              mutate_threshold: float = 0.1, perturb_mult: float = 0.1, max_rounds: int = 25, output_folder: str = 'output', core_count: int = 4,
+              batch_engine: bool = False, seed: int = None, duplicate: bool = False, evolve_bids: bool = False,
+              resume: bool = False, racing: bool = False, racing_step: int = 10, racing_confidence: float = 0.95,
+              migration=None, early_termination: int = 0, lead_rounds: int = 10, time_budget: float = None,
+              record_games: bool = False):
         """
         One generation per game; only the winners continue to the next generation
+        Every agent plays games_per_gen games per generation and all of them count towards its fitness
+        If batch_engine is set, each generation's self-play is played as one BatchSpades batch instead of on the worker pool,
+        which is not overlapped with the logging of the generation before it as the pool's games are
+        seed drives every random choice of the run, including each game's deal; a fresh one is drawn if not given
+        If duplicate is set, every table plays its deals twice with the teams swapped, and agents are selected
+        by their total score margin instead of their win count, which removes part of the luck of the deal
+        Only play weights are optimized unless evolve_bids is set
+        The best agent of every generation is appended to the run's CheckpointStore
+        The full training state is saved to output_folder after every generation, and if resume is set,
+        training picks up from the state saved there, with the seed of the original run
+        If racing is set, each generation is raced in rungs of rounds that double from racing_step (see racing_schedule),
+        up to games_per_gen rounds in all: after each rung, agents whose upper confidence bound is below the lower bounds of
+        select_number others stop playing (see FitnessAggregator.survivors), with racing_confidence holding jointly over the generation,
+        and the rest play on until no more than select_number are left. Agents are ranked by the rung they reached,
+        then by win rate, or by mean score margin per game if duplicate is set, so racing only changes the selection
+        when a confidence bound is wrong
+        early_termination and lead_rounds set when decided games end early (see EarlyTermination)
+        time_budget caps the wall time of each game in seconds (each batch with batch_engine), ending it with the leader as the winner
+        migration is the Migration that exchanges agents with other islands when training as one island of train_islands
+        If record_games is set, every game played on the worker pool is recorded under game_records in output_folder,
+        in one record set per worker (see records.GameRecordWriter); the batch engine keeps no history to record
         """
+        if record_games and batch_engine:
+            raise AttributeError("record_games requires the worker pool, not batch_engine")
+        if resume:
+            state = load_training_state(output_folder)
+            seed = state['seed']
+        seed_seq = as_seed_sequence(seed)
+        train_seed, worker_seed, game_seed = seed_seq.spawn(3)
+        if resume:
+            game_seed = np.random.SeedSequence(game_seed.entropy, spawn_key=game_seed.spawn_key,
+                                               n_children_spawned=state['game_seeds_spawned'])
+
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
         
@@ -106,144 +163,163 @@ class ConstantWeightsGenetic(TrainedAgent):
             max_rounds=max_rounds,
             output_folder=output_folder,
             core_count=core_count,
+            batch_engine=batch_engine,
+            seed=seed_seq.entropy,
+            duplicate=duplicate,
+            evolve_bids=evolve_bids,
+            resume=resume,
+            racing=racing,
+            racing_step=racing_step,
+            racing_confidence=racing_confidence,
+            early_termination=early_termination,
+            lead_rounds=lead_rounds,
+            time_budget=time_budget,
+            record_games=record_games,
         )
         with open(f'{output_folder}/config.json', 'w') as f:
             ujson.dump(config, f, indent=4)
 
-        rng = np.random.default_rng()
+        rng = np.random.default_rng(train_seed)
 
         if population_size % 4 != 0:
             raise AttributeError("population size must be a multiple of 4")
         if population_size < select_number * 2:
             raise AttributeError("select number must be < 1/2 of population size")
 
-        # initialize the first population of agents
-        agents = list()
-        for _ in range(population_size):
-            agents.append(cls())
-
-        for gen_num in range(num_generations):
-            logger.info(f'Starting generation', generation=gen_num)
-            for round_num in range(games_per_gen):
-                logger.info('Starting self-play round', round_num=round_num)
-                rng.shuffle(agents)
-                mp_queue = multiprocessing.Queue()
-                compiled_results = queue.Queue()
-                jobs = []
-                for game_num in range(population_size // 4):
-                    agent_offset = game_num * 4
-                    players = agents[agent_offset:agent_offset + 4]
-                    #! Uncomment below and comment process stuff to disable multiprocessing
-                    # spades_game = Spades(players, max_rounds=20)
-                    # result = spades_game.game()
-                    # result['pid'] = agent_offset
-                    # compiled_results.put(result)
-                    process = multiprocessing.Process(target=multiprocess_spades_game, args=(mp_queue, agent_offset, players), kwargs=dict(max_rounds=max_rounds))
-                    jobs.append(process)
-                    process.start()
-
-                    # wait for core_count processes at a time since only that many can run simultaneously
-                    if len(jobs) == core_count or len(jobs) == population_size // 4:
-                        [compiled_results.put(mp_queue.get()) for process in jobs]
-                        for process in jobs:
-                            process.join()
-                            logger.debug('process terminated', exitcode=process.exitcode)
-                        jobs.clear()
-
-            while not compiled_results.empty():
-                results = compiled_results.get()
-                agent_offset = results.get('pid')
-                if results.get('winning_players') is not None:
-                    for index in results.get('winning_players'):
-                        agents[agent_offset + index].win_count += 1
-
-            winning_agents = sorted(agents, key=lambda x: x.win_count, reverse=True)[:select_number]  # choose the best ones to keep and repopulate
-            agents = winning_agents.copy()
-            logger.info('Top 4 win rates:')
-            for i, each_agent in enumerate(winning_agents[:4]):
-                logger.info(f'\tAgent #{i+1}', win_rate=each_agent.win_count / games_per_gen)
-
-            if gen_num % 20 == 0:
-                most_wins = winning_agents[0].win_count
-                best_agent = winning_agents[0]
-                for agent in winning_agents:
-                    if agent.win_count > most_wins:
-                        most_wins = agent.win_count
-                        best_agent = agent
-                with open(f'{output_folder}/stats_checkpoint_{gen_num}.txt', 'w+') as f:
-                    f.write(f'WIN_RATE: {best_agent.win_count} / {num_validation_games}')
-                with open(f'{output_folder}/bid_weights_checkpoint_{gen_num}', 'wb') as f:
-                    np.save(f, best_agent.bid_weights)
-                with open(f'{output_folder}/play_weights_checkpoint_{gen_num}', 'wb') as f:
-                    np.save(f, best_agent.play_weights)
-
-            # perturb winner weights to repopulate
-            index = 0
-            while len(agents) < population_size:
-                if rng.random() < mutate_threshold:
-                    new_bid_weights = rng.random((1, Bid.BID_LEN))
-                    new_play_weights = rng.random((1, Card.CARD_LEN))
+        # the workers and the shared memory are released however training ends
+        with contextlib.ExitStack() as resources:
+            # initialize the first population of agents, in shared memory so that the workers can read each generation in place
+            population = SharedPopulation(population_size, cls, rng)
+            resources.callback(population.close)
+            start_generation = 0
+            if resume:
+                if state['play_weights'].shape != population.play_weights.shape:
+                    raise AttributeError("population size must match the run being resumed")
+                population.bid_weights[:] = state['bid_weights']
+                population.play_weights[:] = state['play_weights']
+                rng.bit_generator.state = state['rng_state']
+                start_generation = state['generation']
+                logger.info('Resuming training', generation=start_generation, seed=seed_seq.entropy)
+
+            def play_rounds(num_rounds, active=None):
+                """
+                Streams num_rounds self-play rounds to the workers, each a random split of the population into tables of 4,
+                and yields the results as they finish, with 'pid' the population index of the agent in each seat
+                If the population indices of the active agents are given, only they are split into tables,
+                with the last table filled up by random other agents
+                """
+                if active is None:
+                    orders = [rng.permutation(population_size) for _ in range(num_rounds)]
                 else:
-                    new_bid_weights = perturb_mult * (rng.random((1, Bid.BID_LEN)) - 0.5) + winning_agents[index].bid_weights
-                    new_play_weights = perturb_mult * (rng.random((1, Card.CARD_LEN)) - 0.5) + winning_agents[index].play_weights
-                    # normalize values to [0, 1]
-                    bid_min = np.min(new_bid_weights)
-                    bid_max = np.max(new_bid_weights)
-                    new_bid_weights = (new_bid_weights - bid_min) / (bid_max - bid_min)
-                    play_min = np.min(new_play_weights)
-                    play_max = np.max(new_play_weights)
-                    new_play_weights = (new_play_weights - play_min) / (play_max - play_min)
-
-                #! switch the below two lines to toggle bid weight optimization
-                agents.append(cls(play_weights=new_play_weights))
-                # agents.append(cls(bid_weights=new_bid_weights, play_weights=new_play_weights))
-                winning_agents[index].win_count = 0  # reset while we're going through the winning agents anyway
-                index = (index + 1) % len(winning_agents)
-
-            winning_agents.clear()
-
-        # after final evolution, run a number of games and output the weights with the highest win rate
-        for gen_num in range(num_validation_games):
-            print(f'Validation game {gen_num}')
-            rng.shuffle(agents)
-            mp_queue = multiprocessing.Queue()
-            jobs = []
-            for game_num in range(population_size // 4):
-                agent_offset = game_num * 4
-                players = agents[agent_offset:agent_offset + 4]
-                #! Uncomment below and comment process stuff to disable multiprocessing
-                # spades_game = Spades(players, max_rounds=20)
-                # result = spades_game.game()
-                # result['pid'] = agent_offset
-                # queue.put(result)
-                process = multiprocessing.Process(target=multiprocess_spades_game, args=(mp_queue, agent_offset, players), kwargs=dict(max_rounds=max_rounds))
-                process.start()
-                jobs.append(process)
-
-                # wait for core_count processes at a time since only that many can run simultaneously
-                if len(jobs) == core_count or len(jobs) == population_size // 4 - 1:
-                    for process in jobs:
-                        process.join()
-                    jobs.clear()
-
-            while not mp_queue.empty():
-                results = mp_queue.get()
-                agent_offset = results.get('pid')
-                if results.get('winning_players') is not None:
-                    for index in results.get('winning_players'):
-                        agents[agent_offset + index].win_count += 1
-
-        most_wins = agents[0].win_count
-        best_agent = agents[0]
-        for agent in agents:
-            if agent.win_count > most_wins:
-                most_wins = agent.win_count
-                best_agent = agent
-
-        print(f'Best agent had a win rate of {best_agent.win_count}/{num_validation_games}')
+                    others = np.setdiff1d(np.arange(population_size), active)
+                    orders = [rng.permutation(np.concatenate((active, rng.choice(others, -len(active) % 4, replace=False))))
+                              for _ in range(num_rounds)]
+                tables = [tuple(int(index) for index in order[table_offset:table_offset + 4])
+                          for order in orders for table_offset in range(0, len(order), 4)]
+                if batch_engine:
+                    seats = np.array(tables)
+                    return play_policy_games(np.argmax(population.bid_weights, axis=1)[seats], population.play_weights[seats], rng=rng,
+                                             duplicate=duplicate, pids=tables, **game_kwargs)
+                return pool.play(zip(tables, game_seed.spawn(len(tables))), population_spades_game)
+
+            game_kwargs = dict(max_rounds=max_rounds, early_termination=early_termination, lead_rounds=lead_rounds, time_budget=time_budget)
+            fitness = FitnessAggregator(population_size)
+            if resume:
+                fitness.wins[:], fitness.score_margin[:], fitness.games_played[:] = state['wins'], state['score_margin'], state['games_played']
+            checkpoints = CheckpointWriter()
+            checkpoint_store = CheckpointStore.in_folder(output_folder)
+            checkpoint_store.truncate(start_generation)
+            racing_key = 'mean_margin' if duplicate else 'win_rate'
+            fitness_key = racing_key if racing else 'score_margin' if duplicate else 'wins'
+            games_per_table = 2 if duplicate else 1
+            schedule = racing_schedule(games_per_gen, racing_step) if racing else [games_per_gen]
+            first_rounds = schedule[0]
+            record_folder = None
+            if record_games:
+                record_folder = os.path.join(output_folder, GAME_RECORDS_FOLDER)
+                os.makedirs(record_folder, exist_ok=True)
+            pool = None
+            if not batch_engine:
+                pool = resources.enter_context(GamePool(
+                    core_count, seed=worker_seed, initializer=init_population_worker,
+                    initargs=(population, dict(game_kwargs, result_detail=ResultDetail.SUMMARY), duplicate, record_folder)))
+            def next_rounds(gen_num):
+                """
+                Starts the self-play rounds of generation gen_num, or the validation rounds once every generation has been played
+                """
+                if gen_num < num_generations:
+                    logger.info('Starting generation', generation=gen_num)
+                    return play_rounds(first_rounds)
+                print(f'Running {num_validation_games} validation rounds')
+                return play_rounds(num_validation_games)
+
+            # on the worker pool, the next generation is dispatched as soon as its population is built, and the logging
+            # of the generation before it happens while the workers play, so that they never wait on the trainer
+            gen_start, busy_start = time.perf_counter(), pool.busy_time if pool is not None else 0.0
+            rounds = next_rounds(start_generation)
+            for gen_num in range(start_generation, num_generations):
+                fitness.reset()
+                for results in rounds:
+                    fitness.update(results)
+                rungs = np.zeros(population_size, dtype=int)  # the last racing rung each agent played in
+                active = np.arange(population_size)
+                for rung, num_rounds in enumerate(schedule[1:], start=1):
+                    active = fitness.survivors(active, select_number, racing_key, racing_confidence, len(schedule) - 1)
+                    rungs[active] = rung
+                    if len(active) <= select_number:
+                        break
+                    for results in play_rounds(num_rounds, active):
+                        fitness.update(results)
+
+                # keep the best ones and perturb their weights to repopulate
+                ranking = fitness.ranking(fitness_key, rungs)
+                population.select(ranking[:select_number])
+                # the best agent now sits at the front of the population, and is checkpointed before the state that follows it
+                checkpoint_store.append(gen_num, fitness.wins[ranking[0]], fitness.games_played[ranking[0]],
+                                        population.bid_weights[0], population.play_weights[0])
+                population.repopulate(select_number, mutate_threshold, perturb_mult, evolve_bids)
+                if migration is not None:
+                    migration.exchange(gen_num, population)
+                save_training_state(checkpoints, output_folder, gen_num + 1, population, fitness, rng, seed_seq, game_seed)
+
+                if pool is not None:
+                    rounds = next_rounds(gen_num + 1)
+                gen_time = time.perf_counter() - gen_start
+                gen_start += gen_time
+                log_kwargs = dict()
+                if pool is not None:
+                    busy_time = pool.busy_time - busy_start
+                    busy_start += busy_time
+                    log_kwargs = dict(utilization=pool.utilization(busy_time, gen_time))
+                num_games = int(fitness.games_played.sum()) / 4  # every game counts towards the tallies of 4 agents
+                logger.info('Finished generation', generation=gen_num, games_per_sec=num_games / gen_time, **log_kwargs)
+                if racing:
+                    logger.info('Racing', generation=gen_num, games=int(num_games), survivors=len(active),
+                                budget_used=num_games / (games_per_gen * games_per_table * population_size / 4))
+                if duplicate:
+                    logger.info('Duplicate deals', generation=gen_num, variance_reduction=fitness.variance_reduction())
+
+                logger.info('Top 4 win rates:')
+                for i, index in enumerate(ranking[:4]):
+                    logger.info(f'\tAgent #{i+1}', win_rate=float(fitness.win_rates()[index]), score_margin=int(fitness.score_margin[index]))
+
+                if pool is None:
+                    # the batch engine plays a generation when it is started, so it starts after this one has been timed
+                    rounds = next_rounds(gen_num + 1)
+
+            # after final evolution, run a number of games and output the weights with the highest win rate
+            fitness.reset()
+            for results in rounds:
+                fitness.update(results)
+
+            best_index = fitness.ranking(fitness_key)[0]
+            best_agent = population.agent(best_index, copy=True)
+            checkpoints.wait()
+
+        print(f'Best agent had a win rate of {fitness.wins[best_index]}/{fitness.games_played[best_index]}')
 
         with open(f'{output_folder}/stats.txt', 'w+') as f:
-            f.write(f'WIN_RATE: {best_agent.win_count} / {num_validation_games}')
+            f.write(f'WIN_RATE: {fitness.wins[best_index]} / {fitness.games_played[best_index]}')
         with open(f'{output_folder}/bid_weights_final', 'wb') as f:
             np.save(f, best_agent.bid_weights)
         with open(f'{output_folder}/play_weights_final', 'wb') as f:
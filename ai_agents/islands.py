@@ -0,0 +1,171 @@
+import os
+import time
+import threading
+import multiprocessing
+from multiprocessing.connection import Client, Listener
+
+from ai_agents.genetic import ConstantWeightsGenetic
+from util import as_seed_sequence, get_logger
+
+
+"""
+Implements island-model training: several populations evolve independently, each with its own worker pool,
+and every few generations each island sends copies of its best agents to the next island in a ring.
+"""
+
+
+logger = get_logger('training')
+
+
+class QueueTransport:
+    """
+    Moves migrants between islands running as processes on the same machine, through multiprocessing queues
+    """
+
+    def __init__(self, inbox, outbox):
+        self.inbox = inbox
+        self.outbox = outbox
+
+    @classmethod
+    def ring(cls, num_islands: int):
+        """
+        Returns one transport per island, where island i sends to island i + 1
+        """
+        queues = [multiprocessing.Queue() for _ in range(num_islands)]
+        return [cls(queues[island], queues[(island + 1) % num_islands]) for island in range(num_islands)]
+
+    def start(self):
+        pass
+
+    def send(self, migrants):
+        self.outbox.put(migrants)
+
+    def receive(self):
+        return self.inbox.get()
+
+    def close(self):
+        pass
+
+
+class SocketTransport:
+    """
+    Moves migrants between islands over sockets, so that islands can run on different hosts.
+    Each island listens on its own (host, port) address and connects to the address of the next island.
+    """
+
+    def __init__(self, address, neighbor_address, authkey: bytes = b'spades', connect_timeout: float = 60.0):
+        self.address = tuple(address)
+        self.neighbor_address = tuple(neighbor_address)
+        self.authkey = authkey
+        self.connect_timeout = connect_timeout
+        self.listener = None
+        self.accepting = None
+        self.inbox = None
+        self.outbox = None
+
+    @classmethod
+    def ring(cls, num_islands: int, host: str = 'localhost', port: int = 6000):
+        """
+        Returns one transport per island, where island i listens on port + i and sends to island i + 1
+        """
+        return [cls((host, port + island), (host, port + (island + 1) % num_islands)) for island in range(num_islands)]
+
+    def start(self):
+        """
+        Starts listening; must be called in the island's own process, before any island sends to it
+        The connection from the previous island is accepted in the background, since its authentication
+        handshake would otherwise deadlock with this island connecting to the next one
+        """
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.accepting = threading.Thread(target=self.accept, daemon=True)
+        self.accepting.start()
+
+    def accept(self):
+        self.inbox = self.listener.accept()
+
+    def send(self, migrants):
+        if self.outbox is None:
+            deadline = time.perf_counter() + self.connect_timeout
+            while self.outbox is None:
+                try:
+                    self.outbox = Client(self.neighbor_address, authkey=self.authkey)
+                except ConnectionRefusedError:
+                    if time.perf_counter() > deadline:
+                        raise
+                    time.sleep(0.1)
+        self.outbox.send(migrants)
+
+    def receive(self):
+        self.accepting.join()
+        return self.inbox.recv()
+
+    def close(self):
+        for connection in (self.outbox, self.inbox, self.listener):
+            if connection is not None:
+                connection.close()
+
+
+class Migration:
+    """
+    Exchanges agents with the other islands over a transport every interval generations:
+    copies of the num_migrants best agents are sent out, and the agents received replace the last children of the population
+    """
+
+    def __init__(self, transport, interval: int = 10, num_migrants: int = 2):
+        self.transport = transport
+        self.interval = interval
+        self.num_migrants = num_migrants
+
+    def exchange(self, gen_num: int, population):
+        """
+        Called by train once the population of generation gen_num + 1 has been built, with the best agents at the front
+        """
+        if (gen_num + 1) % self.interval != 0:
+            return
+        self.transport.send((population.bid_weights[:self.num_migrants].copy(), population.play_weights[:self.num_migrants].copy()))
+        bid_weights, play_weights = self.transport.receive()
+        population.bid_weights[-len(bid_weights):] = bid_weights
+        population.play_weights[-len(play_weights):] = play_weights
+        logger.info('Exchanged migrants', generation=gen_num, num_migrants=len(play_weights))
+
+
+def run_island(transport, interval: int, num_migrants: int, train_kwargs):
+    transport.start()
+    try:
+        ConstantWeightsGenetic.train(migration=Migration(transport, interval, num_migrants), **train_kwargs)
+    finally:
+        transport.close()
+
+
+def train_islands(num_islands: int = 4, migration_interval: int = 10, num_migrants: int = 2, transport: str = 'local',
+                  port: int = 6000, output_folder: str = 'output', seed: int = None, **train_kwargs):
+    """
+    Trains num_islands populations in separate processes, each with its own worker pool and output folder,
+    that exchange num_migrants agents in a ring every migration_interval generations
+    transport is 'local' for multiprocessing queues or 'socket' for sockets on localhost starting at port
+    Every island gets its own seed from seed
+    """
+    if transport == 'local':
+        transports = QueueTransport.ring(num_islands)
+    elif transport == 'socket':
+        transports = SocketTransport.ring(num_islands, port=port)
+    else:
+        raise AttributeError("transport must be 'local' or 'socket'")
+
+    island_seeds = [int(island_seed.generate_state(1)[0]) for island_seed in as_seed_sequence(seed).spawn(num_islands)]
+    processes = []
+    for island in range(num_islands):
+        island_kwargs = dict(train_kwargs, output_folder=os.path.join(output_folder, f'island_{island}'), seed=island_seeds[island])
+        process = multiprocessing.Process(target=run_island, args=(transports[island], migration_interval, num_migrants, island_kwargs))
+        process.start()
+        processes.append(process)
+
+    # an island that fails would leave its neighbor waiting for migrants forever, so the others are stopped with it
+    while any(process.is_alive() for process in processes):
+        if any(process.exitcode not in (None, 0) for process in processes):
+            for process in processes:
+                process.terminate()
+        time.sleep(1)
+    failed = [island for island, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'islands {failed} failed')
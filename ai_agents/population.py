@@ -0,0 +1,161 @@
+import os
+import numpy as np
+from multiprocessing import shared_memory
+from multiprocessing.util import Finalize
+
+from cards import Bid, Card
+from spades import Spades, ResultDetail, duplicate_spades_game
+from records import GameRecordWriter
+
+
+class Population:
+    """
+    The bid and play weights of a whole population of weight agents, stored as one (P, 14) and one (P, 52) matrix
+    with a row per agent, so that selection and repopulation are whole-matrix operations.
+    Agents are thin views of their rows, and the weights of a new population are drawn with rng.
+    """
+
+    def __init__(self, population_size: int, agent_class, rng=None):
+        self.population_size = population_size
+        self.agent_class = agent_class
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.bid_weights, self.play_weights = self.allocate()
+        self.bid_weights[:] = agent_class.DEFAULT_BID_WEIGHTS
+        self.play_weights[:] = self.rng.random((population_size, Card.CARD_LEN))
+        self.fix_weights()
+
+    def allocate(self):
+        return np.zeros((self.population_size, Bid.BID_LEN)), np.zeros((self.population_size, Card.CARD_LEN))
+
+    def fix_weights(self, rows=slice(None)):
+        """
+        Replaces zero weights in the given rows, which could cause infinite loops when using argmax, and disables NIL bids
+        """
+        for weights in (self.bid_weights[rows], self.play_weights[rows]):
+            weights[weights == 0] = np.nextafter(0, 1)
+        self.bid_weights[rows, 0] = 0
+
+    def agent(self, index, copy=False):
+        """
+        Returns an agent that plays with the weights at the given index, viewing its row unless copy is set
+        The agent works out its decisions when it is built, so it keeps playing the same way if the row changes later
+        """
+        bid_weights, play_weights = self.bid_weights[index:index + 1], self.play_weights[index:index + 1]
+        if copy:
+            bid_weights, play_weights = bid_weights.copy(), play_weights.copy()
+        return self.agent_class(bid_weights=bid_weights, play_weights=play_weights)
+
+    def agents(self):
+        return [self.agent(index) for index in range(self.population_size)]
+
+    def select(self, indices):
+        """
+        Moves the agents at the given indices, in order, to the front of the population
+        """
+        num_selected = len(indices)
+        self.bid_weights[:num_selected] = self.bid_weights[indices]
+        self.play_weights[:num_selected] = self.play_weights[indices]
+
+    def perturb(self, weights, parents, restarts, perturb_mult: float):
+        """
+        Returns one child of each parent row: a random restart where restarts is set,
+        otherwise a perturbed copy normalized to [0, 1]
+        """
+        children = perturb_mult * (self.rng.random((len(parents), weights.shape[1])) - 0.5) + weights[parents]
+        children_min = children.min(axis=1, keepdims=True)
+        children_max = children.max(axis=1, keepdims=True)
+        children = (children - children_min) / (children_max - children_min)
+        children[restarts] = self.rng.random((np.count_nonzero(restarts), weights.shape[1]))
+        return children
+
+    def repopulate(self, num_parents: int, mutate_threshold: float, perturb_mult: float, evolve_bids: bool = False):
+        """
+        Replaces every agent after the first num_parents with a child of one of them, cycling through the parents in order
+        With probability mutate_threshold a child is a random restart, of its bid weights too if evolve_bids is set
+        Children keep the default bid weights unless evolve_bids is set
+        """
+        parents = np.arange(self.population_size - num_parents) % num_parents
+        restarts = self.rng.random(len(parents)) < mutate_threshold
+        self.play_weights[num_parents:] = self.perturb(self.play_weights, parents, restarts, perturb_mult)
+        if evolve_bids:
+            self.bid_weights[num_parents:] = self.perturb(self.bid_weights, parents, restarts, perturb_mult)
+        else:
+            self.bid_weights[num_parents:] = self.agent_class.DEFAULT_BID_WEIGHTS
+        self.fix_weights(slice(num_parents, None))
+
+
+class SharedPopulation(Population):
+    """
+    A Population stored in shared memory.
+    The trainer updates it in place each generation, and game workers build the agents they need from it,
+    so that a game task only has to carry the population indices of its players.
+    """
+
+    def __init__(self, population_size: int, agent_class, rng=None):
+        self.bid_memory = shared_memory.SharedMemory(create=True, size=population_size * Bid.BID_LEN * 8)
+        self.play_memory = shared_memory.SharedMemory(create=True, size=population_size * Card.CARD_LEN * 8)
+        super().__init__(population_size, agent_class, rng)
+
+    def allocate(self):
+        return (np.ndarray((self.population_size, Bid.BID_LEN), dtype=np.float64, buffer=self.bid_memory.buf),
+                np.ndarray((self.population_size, Card.CARD_LEN), dtype=np.float64, buffer=self.play_memory.buf))
+
+    def close(self, unlink=True):
+        """
+        Releases the shared memory; only the creating process should unlink it
+        """
+        del self.bid_weights, self.play_weights
+        self.bid_memory.close()
+        self.play_memory.close()
+        if unlink:
+            self.bid_memory.unlink()
+            self.play_memory.unlink()
+
+    def __getstate__(self):
+        # workers started without fork receive the shared memory by name and map their own arrays
+        return dict(population_size=self.population_size, agent_class=self.agent_class,
+                    bid_memory=self.bid_memory, play_memory=self.play_memory)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.bid_weights, self.play_weights = self.allocate()
+
+
+POPULATION_WORKER = dict()  # state of a game worker that plays agents from a SharedPopulation
+
+
+def init_population_worker(population, game_kwargs, duplicate=False, record_folder=None):
+    """
+    GamePool initializer for workers that play population_spades_game tasks
+    If record_folder is given, each worker records every game it plays to its own record set there,
+    which is flushed when the worker exits
+    """
+    writer = None
+    if record_folder is not None:
+        writer = GameRecordWriter(os.path.join(record_folder, f'worker_{os.getpid()}'))
+        Finalize(writer, writer.close, exitpriority=0)
+    POPULATION_WORKER.update(population=population, game_kwargs=game_kwargs, duplicate=duplicate, writer=writer)
+
+
+def population_spades_game(task):
+    """
+    Plays one game (or duplicate pair) described by a (table, seed) task, where table holds the population index
+    of the agent in each seat. Returns the results with 'pid' set to the table.
+    Meant to be mapped over a GamePool initialized with init_population_worker.
+    """
+    table, seed = task
+    population = POPULATION_WORKER['population']
+    writer = POPULATION_WORKER['writer']
+    players = [population.agent(index, copy=True) for index in table]
+    game_kwargs = dict(POPULATION_WORKER['game_kwargs'], seed=seed)
+    if POPULATION_WORKER['duplicate']:
+        return duplicate_spades_game((table, players, game_kwargs), record=writer.append if writer is not None else None)
+    if writer is None:
+        results = Spades(players, **game_kwargs).game()
+    else:
+        results = Spades(players, **dict(game_kwargs, result_detail=ResultDetail.FULL)).game()
+        writer.append(results)
+        for key in ('scores', 'bids', 'tricks', 'cards_played'):
+            del results[key]  # the history stays in the worker, as with ResultDetail.SUMMARY
+    results['pid'] = table
+    return results
@@ -1,83 +1,165 @@
 import os, sys
+import hashlib
+import itertools
 import fire
+import ujson
 import numpy as np
 import matplotlib.pyplot as plt
 
 p = os.path.abspath('.')
 sys.path.append(p)
-from util import logger
+from util import as_seed_sequence, get_logger
+from checkpoint import CheckpointStore, import_output_folder
 from cards import Card
-from spades import Spades, play_n_games
+from spades import Spades, GamePool, ResultDetail, duplicate_spades_game, duplicate_variance_reduction, game_tasks, play_n_games, pooled_spades_game
 from agent import DummyAgent, UserAgent, GreedyAgent
 from ai_agents.genetic import ConstantWeightsGenetic
 
 
-def analyze_n_games(players, num_games, max_rounds, core_count=4):
+logger = get_logger('analysis')
+
+
+def tally_results(results_list, duplicate=False):
+    """
+    Returns the incomplete games, team 0 wins, team 1 wins and the duplicate pair margins of a list of game results
+    """
     exceeded_rounds = 0
     team_0_wins = 0
     team_1_wins = 0
-    compiled_results = play_n_games(players, num_games, max_rounds=max_rounds, core_count=core_count)
-    while not compiled_results.empty():
-        results = compiled_results.get()
-        if results.get('winning_players') is not None:
+    margins = []
+    for results in results_list:
+        if duplicate:
+            team_0_wins += results['team_wins'][0]
+            team_1_wins += results['team_wins'][1]
+            exceeded_rounds += 2 - sum(results['team_wins'])
+            margins.append(results['margins'])
+        elif results.get('winning_players') is not None:
             if results.get('winning_players')[0] == 0:
                 team_0_wins += 1
             else:
                 team_1_wins += 1
         else:
             exceeded_rounds += 1
+    return exceeded_rounds, team_0_wins, team_1_wins, margins
+
 
+def analyze_n_games(players, num_games, max_rounds, core_count=4, deal_bank=None, duplicate=False):
+    """
+    If duplicate is set, each of the num_games deals is played twice with the teams swapped,
+    so the counts cover 2 * num_games games
+    """
+    compiled_results = play_n_games(players, num_games, max_rounds=max_rounds, core_count=core_count, deal_bank=deal_bank, duplicate=duplicate)
+    results_list = []
+    while not compiled_results.empty():
+        results_list.append(compiled_results.get())
+    exceeded_rounds, team_0_wins, team_1_wins, margins = tally_results(results_list, duplicate)
+
+    if duplicate:
+        logger.info('Duplicate deals', num_pairs=num_games, mean_margin=float(np.mean(margins) * 2),
+                    variance_reduction=duplicate_variance_reduction(margins))
     return exceeded_rounds, team_0_wins, team_1_wins
 
 
-def cwg_vs_dummy(bid_weights, play_weights, num_games, max_rounds):
+def cwg_vs_dummy(bid_weights, play_weights, num_games, max_rounds, deal_bank=None, duplicate=False):
     logger.info('Playing CWG vs Dummy', num_games=num_games)
     players = [DummyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights),
                DummyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights)]
-    exceeded_rounds, dummy_wins, cwg_wins = analyze_n_games(players, num_games, max_rounds)
+    exceeded_rounds, dummy_wins, cwg_wins = analyze_n_games(players, num_games, max_rounds, deal_bank=deal_bank, duplicate=duplicate)
 
     return (['CWG wins', 'Dummy wins', 'Incomplete games'], [cwg_wins, dummy_wins, exceeded_rounds])
 
 
-def cwg_vs_greedy(bid_weights, play_weights, num_games, max_rounds):
+def cwg_vs_greedy(bid_weights, play_weights, num_games, max_rounds, deal_bank=None, duplicate=False):
     logger.info('Playing CWG vs Greedy', num_games=num_games)
     players = [GreedyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights),
                GreedyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights)]
-    exceeded_rounds, greedy_wins, cwg_wins = analyze_n_games(players, num_games, max_rounds)
+    exceeded_rounds, greedy_wins, cwg_wins = analyze_n_games(players, num_games, max_rounds, deal_bank=deal_bank, duplicate=duplicate)
 
     return (['CWG wins', 'Greedy wins', 'Incomplete games'], [cwg_wins, greedy_wins, exceeded_rounds])
 
 
-def learning_timeline(output_folder, num_games, max_rounds, gen_step=20):
+def evaluation_key(bid_weights, play_weights, opponent, num_games, max_rounds, seed, deal_bank=None, duplicate=False):
+    """
+    Returns the cache key of one evaluation: a hash of the weights and of everything else that decides its games
+    """
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(bid_weights, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(play_weights, dtype=np.float64).tobytes())
+    digest.update(ujson.dumps([opponent, num_games, max_rounds, seed, deal_bank, duplicate]).encode())
+    return digest.hexdigest()
+
+
+def load_evaluation_cache(path):
+    if not os.path.exists(path):
+        return dict()
+    with open(path) as f:
+        return ujson.load(f)
+
+
+def save_evaluation_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        ujson.dump(cache, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def learning_timeline(output_folder, num_games, max_rounds, gen_step=20, deal_bank=None, duplicate=False, start_gen=0, stop_gen=None,
+                      core_count=None, seed=0):
+    """
+    Plays the best agent of every gen_step-th generation in [start_gen, stop_gen) and the final agent against Greedy
+    Checkpoints come from the run's CheckpointStore, which is imported first for runs that predate it
+    The games of every checkpoint go through one job queue on a pool of core_count workers (all cores by default),
+    all seeded from seed so that every checkpoint plays the same deals
+    Results are cached in the output folder by a hash of the weights and the game settings,
+    so that only checkpoints that were not evaluated before are played
+    """
     logger.info('Calculating learning timeline CWG vs Greedy')
-    gen = 0
-    cwg_win_rates = []
-    while os.path.exists(f'{output_folder}/bid_weights_checkpoint_{gen}') and os.path.exists(f'{output_folder}/play_weights_checkpoint_{gen}'):
-        logger.info(f'Running learning timeline', checkpoint=gen)
-
-        bid_weights = np.load(f'{output_folder}/bid_weights_checkpoint_{gen}')
-        play_weights = np.load(f'{output_folder}/play_weights_checkpoint_{gen}')
-        players = [GreedyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights),
-                   GreedyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights)]
-
-        exceeded_rounds, greedy_wins, cwg_wins = analyze_n_games(players, num_games, max_rounds)
-        cwg_win_rates.append(cwg_wins / (cwg_wins + greedy_wins))
-        gen += gen_step
-    
+    store = CheckpointStore.in_folder(output_folder)
+    if not os.path.exists(store.path):
+        import_output_folder(output_folder)
+    checkpoints = store.generations(start_gen, stop_gen)
+    checkpoints = checkpoints[checkpoints['generation'] % gen_step == 0]
+    gens = [int(gen) for gen in checkpoints['generation']]
+    weights = [(checkpoint['bid_weights'].reshape(1, -1).copy(), checkpoint['play_weights'].reshape(1, -1).copy()) for checkpoint in checkpoints]
     # now add the final results on
-    bid_weights = np.load(f'{output_folder}/bid_weights_final')
-    play_weights = np.load(f'{output_folder}/play_weights_final')
-    players = [GreedyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights),
-               GreedyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights)]
+    gens.append(gens[-1] + gen_step if gens else start_gen)
+    weights.append((np.load(f'{output_folder}/bid_weights_final'), np.load(f'{output_folder}/play_weights_final')))
+
+    cache_path = f'{output_folder}/analysis/evaluation_cache.json'
+    cache = load_evaluation_cache(cache_path)
+    keys = [evaluation_key(bid_weights, play_weights, 'greedy', num_games, max_rounds, seed, deal_bank, duplicate)
+            for bid_weights, play_weights in weights]
+    pending = {key: index for index, key in enumerate(keys) if key not in cache}
+    logger.info('Evaluating checkpoints', num_checkpoints=len(keys), cached=len(keys) - len(pending))
+    if pending:
+        tasks = []
+        for key, index in pending.items():
+            bid_weights, play_weights = weights[index]
+            players = [GreedyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights),
+                       GreedyAgent(), ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights)]
+            worker_seed, game_seed = as_seed_sequence(seed).spawn(2)
+            tasks.append(game_tasks(players, num_games, game_seed, pid=key, deal_bank=deal_bank, max_rounds=max_rounds,
+                                    result_detail=ResultDetail.WINNER))
+
+        results_lists = {key: [] for key in pending}
+        with GamePool(core_count or os.cpu_count(), seed=worker_seed) as pool:
+            for results in pool.play(itertools.chain(*tasks), duplicate_spades_game if duplicate else pooled_spades_game):
+                results_lists[results['pid']].append(results)
+        for key, results_list in results_lists.items():
+            exceeded_rounds, greedy_wins, cwg_wins, margins = tally_results(results_list, duplicate)
+            cache[key] = [exceeded_rounds, greedy_wins, cwg_wins]
+        save_evaluation_cache(cache_path, cache)
 
-    exceeded_rounds, greedy_wins, cwg_wins = analyze_n_games(players, num_games, max_rounds)
-    cwg_win_rates.append(cwg_wins / (cwg_wins + greedy_wins))
-
-    return (np.arange(0, gen + 1, gen_step), cwg_win_rates)
+    cwg_win_rates = []
+    for gen, key in zip(gens, keys):
+        exceeded_rounds, greedy_wins, cwg_wins = cache[key]
+        logger.info('Learning timeline', checkpoint=gen, cwg_wins=cwg_wins, greedy_wins=greedy_wins)
+        cwg_win_rates.append(cwg_wins / (cwg_wins + greedy_wins))
 
+    return (np.array(gens), cwg_win_rates)
 
 
-def main(output_folder=None, bid_weights=None, play_weights=None, num_games=100, timeline=False, max_rounds=100):
+def main(output_folder=None, bid_weights=None, play_weights=None, num_games=100, timeline=False, max_rounds=100, deal_bank=None, duplicate=False):
     if output_folder is None:
         if bid_weights is None or play_weights is None:
             print('Either Output folder path or Bid and Play weight filepaths must be provided')
@@ -119,7 +201,7 @@ def main(output_folder=None, bid_weights=None, play_weights=None, num_games=100,
     # plt.ylabel('Count')
 
     plt.figure()
-    labels, win_counts = cwg_vs_greedy(bid_weights, play_weights, num_games, max_rounds)
+    labels, win_counts = cwg_vs_greedy(bid_weights, play_weights, num_games, max_rounds, deal_bank=deal_bank, duplicate=duplicate)
     plt.bar(labels, win_counts)
     plt.title('Constant Weight Genetic vs Greedy (100 games)')
     plt.xlabel('Game result')
@@ -127,7 +209,7 @@ def main(output_folder=None, bid_weights=None, play_weights=None, num_games=100,
 
     if timeline:
         plt.figure()
-        gens, cwg_win_rates = learning_timeline(output_folder, num_games, max_rounds)
+        gens, cwg_win_rates = learning_timeline(output_folder, num_games, max_rounds, deal_bank=deal_bank, duplicate=duplicate)
         best_cwg = np.argmax(cwg_win_rates)
         num_gens = len(gens)
         plt.annotate(f'Best Generation: {gens[best_cwg]}\nWin Rate: {cwg_win_rates[best_cwg]}', (gens[best_cwg], cwg_win_rates[best_cwg]),
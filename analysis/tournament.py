@@ -0,0 +1,189 @@
+import os, sys
+import glob
+import itertools
+import fire
+import ujson
+import numpy as np
+
+p = os.path.abspath('.')
+sys.path.append(p)
+from util import as_seed_sequence, get_logger
+from spades import GamePool, duplicate_spades_game, game_tasks
+from agent import DummyAgent, GreedyAgent
+from ai_agents.genetic import ConstantWeightsGenetic
+from checkpoint import CheckpointStore, import_output_folder
+
+
+"""
+Implements a round-robin tournament with Elo ratings between any mix of Dummy, Greedy and trained agents.
+An entrant is named by a spec: 'dummy', 'greedy', an output folder for its final agent,
+or 'output_folder:N' for the best agent of generation N in the run's CheckpointStore.
+"""
+
+
+logger = get_logger('analysis')
+
+FIXED_ENTRANTS = dict(dummy=DummyAgent, greedy=GreedyAgent)
+
+
+def load_entrant_weights(spec):
+    """
+    Returns the (bid_weights, play_weights) of a trained entrant spec
+    """
+    output_folder, _, gen = spec.partition(':')
+    if not gen:
+        return np.load(f'{output_folder}/bid_weights_final'), np.load(f'{output_folder}/play_weights_final')
+    store = CheckpointStore.in_folder(output_folder)
+    if not os.path.exists(store.path):
+        import_output_folder(output_folder)
+    checkpoints = store.generations(int(gen), int(gen) + 1)
+    if len(checkpoints) == 0:
+        raise AttributeError(f"{output_folder} has no checkpoint for generation {gen}")
+    return checkpoints[0]['bid_weights'].reshape(1, -1).copy(), checkpoints[0]['play_weights'].reshape(1, -1).copy()
+
+
+def entrant_player(spec):
+    """
+    Returns a new agent for an entrant spec; each seat needs its own agent, since the agent holds the seat's hand
+    """
+    if spec in FIXED_ENTRANTS:
+        return FIXED_ENTRANTS[spec]()
+    bid_weights, play_weights = load_entrant_weights(spec)
+    return ConstantWeightsGenetic(bid_weights=bid_weights, play_weights=play_weights)
+
+
+def fit_ratings(entrants, matches, initial_rating: float = 1500, prior_games: float = 2, tolerance: float = 1e-9, max_iterations: int = 10000):
+    """
+    Returns the Elo-scale ratings of the entrants that best explain the tallies of every match played (a Bradley-Terry fit),
+    with incomplete games counted as draws
+    Every entrant is also given prior_games drawn games against a virtual entrant rated initial_rating, which keeps
+    the ratings of unbeaten or winless entrants finite and leaves entrants without matches at initial_rating
+    """
+    index = {spec: i for i, spec in enumerate(entrants)}
+    num_entrants = len(entrants)
+    scores = np.zeros((num_entrants + 1, num_entrants + 1))  # scores[i, j] is i's score against j; the last entrant is virtual
+    for match in matches.values():
+        first, second = index[match['first']], index[match['second']]
+        draws = match['games'] - match['wins'][0] - match['wins'][1]
+        scores[first, second] += match['wins'][0] + draws / 2
+        scores[second, first] += match['wins'][1] + draws / 2
+    scores[:num_entrants, num_entrants] += prior_games / 2
+    scores[num_entrants, :num_entrants] += prior_games / 2
+    games = scores + scores.T
+
+    # minorization-maximization updates, with the virtual entrant's strength held at 1
+    strength = np.ones(num_entrants + 1)
+    for _ in range(max_iterations):
+        updated = scores[:num_entrants].sum(axis=1) / (games[:num_entrants] / (strength[:num_entrants, None] + strength)).sum(axis=1)
+        change = np.max(np.abs(updated - strength[:num_entrants]), initial=0)
+        strength[:num_entrants] = updated
+        if change < tolerance:
+            break
+    return {spec: float(initial_rating + 400 * np.log10(strength[i])) for spec, i in index.items()}
+
+
+class Tournament:
+    """
+    A round-robin tournament in which every match pits two entrants against each other, each as a team of two copies.
+    Matches are played as pairs_per_match duplicate pairs on the same seeded deals, so that both teams play both sides of every deal.
+    Entrants, match results and ratings are kept in a JSON file at path,
+    so that entrants added later only play their own matches and finished matches are never replayed.
+    Ratings are Elo-scale ratings refit from the tallies of every match played so far (see fit_ratings),
+    so they do not depend on the order the matches were played in.
+    """
+
+    def __init__(self, path, pairs_per_match: int = 50, max_rounds: int = 25, seed: int = 0, initial_rating: float = 1500, prior_games: float = 2):
+        """
+        The settings are only used for a new tournament; an existing one keeps the settings it was created with
+        """
+        self.path = path
+        self.state = dict(
+            settings=dict(pairs_per_match=pairs_per_match, max_rounds=max_rounds, seed=seed, initial_rating=initial_rating, prior_games=prior_games),
+            entrants=[],
+            matches=dict(),
+            ratings=dict(),
+        )
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = ujson.load(f)
+        self.settings = self.state['settings']
+
+    def save(self):
+        with open(f'{self.path}.tmp', 'w') as f:
+            ujson.dump(self.state, f, indent=4)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def add(self, *specs):
+        for spec in specs:
+            if spec not in self.state['entrants']:
+                entrant_player(spec)  # fail now rather than in the middle of a match
+                self.state['entrants'].append(spec)
+                self.state['ratings'][spec] = self.settings['initial_rating']
+
+    @staticmethod
+    def match_key(first, second):
+        return f'{first} vs {second}'
+
+    def pending_matches(self):
+        return [(first, second) for first, second in itertools.combinations(self.state['entrants'], 2)
+                if self.match_key(first, second) not in self.state['matches']]
+
+    def play(self, core_count: int = None):
+        """
+        Plays every pending match as one job queue on a pool of core_count workers (all cores by default),
+        then records the results and refits the ratings from every match played so far
+        """
+        pending = self.pending_matches()
+        logger.info('Playing tournament matches', pending=len(pending), finished=len(self.state['matches']))
+        if pending:
+            self.play_matches(pending, core_count)
+        self.state['ratings'] = fit_ratings(self.state['entrants'], self.state['matches'], self.settings['initial_rating'],
+                                            self.settings.get('prior_games', 2))
+        self.save()
+
+    def play_matches(self, pending, core_count: int = None):
+        tasks = []
+        for first, second in pending:
+            players = [entrant_player(first), entrant_player(second), entrant_player(first), entrant_player(second)]
+            worker_seed, game_seed = as_seed_sequence(self.settings['seed']).spawn(2)  # every match plays the same deals
+            tasks.append(game_tasks(players, self.settings['pairs_per_match'], game_seed, pid=self.match_key(first, second),
+                                    max_rounds=self.settings['max_rounds']))
+
+        tallies = {self.match_key(first, second): dict(wins=[0, 0], margin=0) for first, second in pending}
+        with GamePool(core_count or os.cpu_count(), seed=worker_seed) as pool:
+            for results in pool.play(itertools.chain(*tasks), duplicate_spades_game):
+                tally = tallies[results['pid']]
+                tally['wins'][0] += results['team_wins'][0]
+                tally['wins'][1] += results['team_wins'][1]
+                tally['margin'] += sum(results['margins'])
+
+        for first, second in pending:
+            key = self.match_key(first, second)
+            tally = tallies[key]
+            num_games = 2 * self.settings['pairs_per_match']
+            self.state['matches'][key] = dict(first=first, second=second, games=num_games, **tally)
+
+    def standings(self):
+        """
+        Returns the entrants from highest to lowest rated, as (spec, rating) pairs
+        """
+        return sorted(self.state['ratings'].items(), key=lambda item: -item[1])
+
+
+def main(path='tournament.json', *entrants, all_runs=False, pairs_per_match=50, max_rounds=25, seed=0, core_count=None):
+    """
+    Adds the given entrants (and the final agent of every output_* run if all_runs is set) to the tournament at path,
+    plays every match that has not been played yet and logs the standings
+    """
+    tournament = Tournament(path, pairs_per_match=pairs_per_match, max_rounds=max_rounds, seed=seed)
+    if all_runs:
+        entrants += tuple(sorted(folder for folder in glob.glob('output_*') if os.path.exists(f'{folder}/play_weights_final')))
+    tournament.add(*entrants)
+    tournament.play(core_count)
+    for rank, (spec, rating) in enumerate(tournament.standings()):
+        logger.info('Standings', rank=rank + 1, entrant=spec, rating=round(rating, 1))
+    return tournament.standings()
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,316 @@
+import time
+import fire
+import numpy as np
+
+from cards import Bid, Card, Hand, Suits
+from agent import DummyAgent, GreedyAgent
+from spades import Spades, EarlyTermination, ResultDetail, decided_early, out_of_time, swap_teams
+from dealing import shuffled_decks
+from util import get_logger
+
+
+"""
+Implements a vectorized Spades engine that plays N games in lockstep.
+Every player must have a fixed bid and a fixed card preference (a weight per card),
+which covers DummyAgent, GreedyAgent and ConstantWeightsGenetic.
+"""
+
+
+CARD_SUITS = np.arange(Card.CARD_LEN) // Card.SUIT_LEN
+CARD_RANKS = np.arange(Card.CARD_LEN) % Card.SUIT_LEN
+SUIT_MASKS = np.stack([CARD_SUITS == suit for suit in range(4)])  # (4, 52) mask of the cards in each suit
+SPADES_MASK = SUIT_MASKS[Suits['SPADES']]
+DEALT_SEATS = np.arange(Card.CARD_LEN) // Hand.HAND_LEN  # seat that receives each position of a shuffled deck
+SWAPPED_SEATS = swap_teams(list(range(Spades.NUM_PLAYERS)))  # seat order of a duplicate replay
+
+logger = get_logger('engine')
+
+
+def trick_winner_strength(played_cards, lead_suit):
+    """
+    Returns the (k, 4) strength of each card played to k tricks, given their (k, 4) card indices and (k,) lead suits,
+    so that the trick winner is the seat with the highest strength
+    """
+    # spades beat every other suit, then the lead suit beats the rest
+    played_suits = CARD_SUITS[played_cards]
+    played_ranks = CARD_RANKS[played_cards]
+    strength = np.where(played_suits == lead_suit[:, None], Card.SUIT_LEN + played_ranks, 0)
+    return np.where(played_suits == Suits['SPADES'], 2 * Card.SUIT_LEN + played_ranks, strength)
+
+
+def agent_policy(agent):
+    """
+    Returns the (bid, play_weights) pair that reproduces the agent's decisions in the batch engine,
+    where the agent always plays its highest weighted valid card
+    """
+    if isinstance(agent, DummyAgent):
+        return 3, np.arange(Card.CARD_LEN, 0, -1, dtype=float)  # lowest valid card
+    if isinstance(agent, GreedyAgent):
+        return 3, np.arange(1, Card.CARD_LEN + 1, dtype=float)  # highest valid card
+    if hasattr(agent, 'bid_weights') and hasattr(agent, 'play_weights'):
+        return int(np.argmax(agent.bid_weights)), np.asarray(agent.play_weights, dtype=float).reshape(Card.CARD_LEN)
+    raise TypeError(f'{type(agent).__name__} has no fixed policy and cannot be played in the batch engine')
+
+
+def table_policies(tables):
+    """
+    Returns the (N, 4) bids and (N, 4, 52) play weights of a list of N tables of 4 players each
+    """
+    bids = np.zeros((len(tables), Spades.NUM_PLAYERS), dtype=int)
+    play_weights = np.zeros((len(tables), Spades.NUM_PLAYERS, Card.CARD_LEN))
+    for game_num, players in enumerate(tables):
+        if len(players) != Spades.NUM_PLAYERS:
+            raise AttributeError("Each table must have 4 players")
+        for seat, player in enumerate(players):
+            bids[game_num, seat], play_weights[game_num, seat] = agent_policy(player)
+    return bids, play_weights
+
+
+class BatchSpades:
+    """
+    Plays N games at once, with hands stored as (N, 4, 52) masks and bids, tricks and scores as stacked arrays.
+    Games that finish early drop out of the batch for the remaining rounds.
+    """
+
+    def __init__(self, bids, play_weights, *args, nil_points: int = 100, win_points: int = 500, max_rounds: int = 1000,
+                 early_termination: EarlyTermination = EarlyTermination.NONE, lead_rounds: int = 10, time_budget: float = None, **kwargs):
+        """
+        time_budget is the wall time in seconds the whole batch may take, after which every unfinished game ends as in Spades
+        """
+        self.bids = np.asarray(bids, dtype=int)  # (N, 4) bid of each seat
+        self.play_weights = np.asarray(play_weights, dtype=float)  # (N, 4, 52) card preference of each seat
+        if self.bids.ndim != 2 or self.bids.shape[1] != Spades.NUM_PLAYERS:
+            raise AttributeError("bids must have shape (N, 4)")
+        if self.play_weights.shape != self.bids.shape + (Card.CARD_LEN,):
+            raise AttributeError("play weights must have shape (N, 4, 52)")
+        self.num_games = self.bids.shape[0]
+
+        # Game properties
+        self.nil_points = nil_points
+        self.win_points = win_points
+        self.max_rounds = max_rounds
+        self.early_termination = EarlyTermination(early_termination)
+        self.lead_rounds = lead_rounds
+        self.time_budget = time_budget
+
+    @classmethod
+    def from_players(cls, tables, **kwargs):
+        """
+        Initializes a batch from a list of N tables of 4 players each
+        """
+        return cls(*table_policies(tables), **kwargs)
+
+    def deal(self, rng, num_games=None):
+        """
+        Returns a (max_rounds + 1, num_games, 52) array of shuffled decks, one for every round each game could last.
+        Seat s is dealt positions [13s, 13s + 13) of the deck.
+        """
+        if num_games is None:
+            num_games = self.num_games
+        return shuffled_decks(rng, (self.max_rounds + 1) * num_games).reshape((self.max_rounds + 1, num_games, Card.CARD_LEN))
+
+    def round(self, decks, games, dealer_player):
+        """
+        Plays one round of the given games from their (k, 52) shuffled decks and returns the (k, 4) tricks won
+        """
+        num_games = len(games)
+        rows = np.arange(num_games)
+        play_weights = self.play_weights[games]
+        hands = np.zeros((num_games, Spades.NUM_PLAYERS, Card.CARD_LEN), dtype=bool)
+        hands[rows[:, None], DEALT_SEATS, decks] = True
+
+        tricks = np.zeros((num_games, Spades.NUM_PLAYERS), dtype=int)
+        starting_player = np.full(num_games, (dealer_player + 1) % Spades.NUM_PLAYERS)
+        spades_broken = np.zeros(num_games, dtype=bool)
+        for _ in range(Hand.HAND_LEN):
+            played_cards = np.zeros((num_games, Spades.NUM_PLAYERS), dtype=int)
+            for turn_index in range(Spades.NUM_PLAYERS):
+                seats = (starting_player + turn_index) % Spades.NUM_PLAYERS
+                hand = hands[rows, seats]
+                if turn_index == 0:
+                    # spades can only be led once broken, or if the hand holds nothing else
+                    off_suit = hand & ~SPADES_MASK
+                    can_lead_spades = spades_broken | ~off_suit.any(axis=1)
+                    legal = np.where(can_lead_spades[:, None], hand, off_suit)
+                else:
+                    # suit must be followed if possible
+                    follow = hand & SUIT_MASKS[lead_suit]
+                    legal = np.where(follow.any(axis=1)[:, None], follow, hand)
+                cards = np.argmax(np.where(legal, play_weights[rows, seats], -np.inf), axis=1)
+                if turn_index == 0:
+                    lead_suit = CARD_SUITS[cards]
+
+                hands[rows, seats, cards] = False
+                spades_broken |= CARD_SUITS[cards] == Suits['SPADES']
+                played_cards[rows, seats] = cards
+
+            winners = np.argmax(trick_winner_strength(played_cards, lead_suit), axis=1)
+            tricks[rows, winners] += 1
+            starting_player = winners
+        return tricks
+
+    def score(self, bids, tricks, prev_scores):
+        """
+        Returns the (k, 2) score change of each team for one round
+        """
+        round_score = np.zeros((len(bids), 2))
+        for team in range(2):
+            team_score = np.zeros(len(bids))
+            team_bags = np.zeros(len(bids))
+            prev_bags = np.mod(prev_scores[:, team], 10)
+            team_bid = bids[:, team] + bids[:, team + 2]
+            team_tricks = tricks[:, team] + tricks[:, team + 2]
+            # account for null bids
+            for player in (team, team + 2):
+                nil = bids[:, player] == 0
+                failed = nil & (tricks[:, player] > 0)
+                team_score += np.where(nil, np.where(failed, -self.nil_points, self.nil_points), 0)
+                team_bags += np.where(failed, tricks[:, player], 0)
+                team_tricks -= np.where(failed, tricks[:, player], 0)  # any tricks on a null bid go straight to bags
+
+            made_bid = team_tricks >= team_bid
+            team_score += np.where(made_bid, team_bid * 10, -team_bid)
+            team_bags += np.where(made_bid, team_tricks - team_bid, 0)
+
+            team_score += team_bags
+            team_score -= np.where(prev_bags + team_bags >= 10, 100, 0)
+            round_score[:, team] = team_score
+        return round_score
+
+    def game(self, rng=None, decks=None):
+        """
+        Plays every game in the batch to completion.
+        Returns the winning team of each game (-1 if it exceeded max_rounds, or ran out of time while tied), the final scores,
+        the rounds played and whether each game was ended early by the early_termination policy or the time budget.
+        """
+        if decks is None:
+            decks = self.deal(rng if rng is not None else np.random.default_rng())
+
+        scores = np.zeros((self.num_games, 2))
+        rounds = np.zeros(self.num_games, dtype=int)
+        finished = np.zeros(self.num_games, dtype=bool)
+        exceeded_rounds = np.zeros(self.num_games, dtype=bool)
+        ended_early = np.zeros(self.num_games, dtype=bool)
+        start = time.perf_counter()
+        for round_num in range(self.max_rounds + 1):
+            games = np.flatnonzero(~finished)
+            if len(games) == 0:
+                break
+            tricks = self.round(decks[round_num, games], games, round_num % Spades.NUM_PLAYERS)
+            scores[games] += self.score(self.bids[games], tricks, scores[games])
+            rounds[games] += 1
+
+            if round_num + 1 > self.max_rounds:
+                exceeded_rounds[games] = True
+                finished[games] = True
+            else:
+                game_scores = scores[games]
+                max_score = np.max(game_scores, axis=1)
+                won = (max_score - np.min(game_scores, axis=1) >= self.win_points) | (max_score >= self.win_points)
+                ended_early[games] = ~won & decided_early(self.early_termination, round_num + 1, game_scores, self.max_rounds,
+                                                          self.lead_rounds, self.nil_points)
+                finished[games] = won | ended_early[games]
+            if out_of_time(start, self.time_budget):
+                unfinished = games[~finished[games]]
+                ended_early[unfinished] = True
+                exceeded_rounds[unfinished] = scores[unfinished, 0] == scores[unfinished, 1]  # a tied game out of time has no winner
+                finished[unfinished] = True
+        if logger.debug_enabled:
+            logger.debug('Batch finished', num_games=self.num_games, max_rounds_played=np.max(rounds, initial=0))
+
+        winning_team = np.where(exceeded_rounds, -1, np.argmax(scores, axis=1))
+        return dict(winning_team=winning_team, scores=scores, rounds=rounds, ended_early=ended_early)
+
+
+def play_batch_games(tables, rng=None, duplicate=False, pids=None, **kwargs):
+    """
+    Plays one game per table of 4 players in a single batch.
+    Returns a list of results shaped like the ResultDetail.SUMMARY results of Spades.game,
+    with 'pid' the offset of the table (4 * table index) unless a list of pids is given
+    If duplicate is set, each table also replays its deals with the teams swapped
+    and the results are shaped like those of duplicate_spades_game
+    """
+    return play_policy_games(*table_policies(tables), rng=rng, duplicate=duplicate, pids=pids, **kwargs)
+
+
+def play_policy_games(bids, play_weights, rng=None, duplicate=False, pids=None, **kwargs):
+    """
+    Same as play_batch_games, for tables given directly as (N, 4) bids and (N, 4, 52) play weights
+    """
+    num_tables = len(bids)
+    if pids is None:
+        pids = [game_num * 4 for game_num in range(num_tables)]
+    if not duplicate:
+        results = BatchSpades(bids, play_weights, **kwargs).game(rng)
+        compiled_results = []
+        for game_num, winning_team in enumerate(results['winning_team']):
+            compiled_results.append(dict(
+                winning_players=None if winning_team == -1 else [int(winning_team), int(winning_team) + 2],
+                final_scores=results['scores'][game_num].astype(np.int32),
+                rounds=results['rounds'][game_num],
+                ended_early=bool(results['ended_early'][game_num]),
+                pid=pids[game_num],
+            ))
+        return compiled_results
+
+    bids, play_weights = np.asarray(bids), np.asarray(play_weights)
+    batch = BatchSpades(np.concatenate((bids, bids[:, SWAPPED_SEATS])),
+                        np.concatenate((play_weights, play_weights[:, SWAPPED_SEATS])), **kwargs)
+    decks = batch.deal(rng if rng is not None else np.random.default_rng(), num_tables)
+    results = batch.game(decks=np.concatenate((decks, decks), axis=1))
+    margins = results['scores'][:, 0] - results['scores'][:, 1]
+    compiled_results = []
+    for game_num in range(num_tables):
+        first_winner, second_winner = results['winning_team'][game_num], results['winning_team'][num_tables + game_num]
+        team_wins = [0, 0]
+        if first_winner != -1:
+            team_wins[first_winner] += 1
+        if second_winner != -1:
+            team_wins[1 - second_winner] += 1
+        compiled_results.append(dict(
+            pid=pids[game_num],
+            margins=[int(margins[game_num]), -int(margins[num_tables + game_num])],
+            team_wins=team_wins,
+        ))
+    return compiled_results
+
+
+def check_against_scalar(num_games=200, max_rounds=25, seed=0, early_termination=EarlyTermination.NONE, lead_rounds=10):
+    """
+    Plays seeded deals with random mixes of agents in both engines and reports any game where they disagree
+    """
+    from ai_agents.genetic import ConstantWeightsGenetic
+
+    rng = np.random.default_rng(seed)
+    agent_types = [DummyAgent, GreedyAgent, ConstantWeightsGenetic]
+    tables = []
+    for _ in range(num_games):
+        players = []
+        for agent_index in rng.integers(0, len(agent_types), Spades.NUM_PLAYERS):
+            agent_type = agent_types[agent_index]
+            if agent_type is ConstantWeightsGenetic:
+                players.append(ConstantWeightsGenetic(bid_weights=rng.random((1, Bid.BID_LEN)), play_weights=rng.random((1, Card.CARD_LEN))))
+            else:
+                players.append(agent_type())
+        tables.append(players)
+
+    game_kwargs = dict(max_rounds=max_rounds, early_termination=early_termination, lead_rounds=lead_rounds)
+    batch = BatchSpades.from_players(tables, **game_kwargs)
+    decks = batch.deal(rng)
+    batch_results = batch.game(decks=decks)
+
+    mismatches = 0
+    for game_num, players in enumerate(tables):
+        results = Spades(players, result_detail=ResultDetail.SUMMARY, deal_bank=decks[:, game_num], **game_kwargs).game()
+        winning_team = -1 if results['winning_players'] is None else results['winning_players'][0]
+        if (winning_team != batch_results['winning_team'][game_num] or results['rounds'] != batch_results['rounds'][game_num]
+                or not np.array_equal(results['final_scores'], batch_results['scores'][game_num])
+                or results['ended_early'] != batch_results['ended_early'][game_num]):
+            mismatches += 1
+            logger.info('Engines disagree', game=game_num, scalar=results['final_scores'], batch=batch_results['scores'][game_num])
+    logger.info('Checked batch engine against scalar engine', num_games=num_games, mismatches=mismatches)
+    return mismatches
+
+
+if __name__ == '__main__':
+    fire.Fire(check_against_scalar)
@@ -0,0 +1,85 @@
+import os, sys
+import time
+import fire
+import numpy as np
+
+p = os.path.abspath('.')
+sys.path.append(p)
+from util import get_logger
+from cards import Bid, bits_to_array
+from spades import Spades, ResultDetail
+from ai_agents.genetic import ConstantWeightsGenetic
+
+
+"""
+Measures the decisions/sec of constant weight agents, against the masked argmax they used to recompute for every decision.
+"""
+
+
+logger = get_logger('analysis')
+
+
+def record_legal_plays(players, num_games, max_rounds, seed):
+    """
+    Plays num_games games and returns the (player, legal_plays) of every play decision made in them
+    """
+    decisions = []
+    for player in players:
+        def recording_get_play(*args, player=player, get_play=player.get_play):
+            decisions.append((player, args[-1]))
+            return get_play(*args)
+        player.get_play = recording_get_play
+    for game_seed in np.random.SeedSequence(seed).spawn(num_games):
+        Spades(players, max_rounds=max_rounds, result_detail=ResultDetail.WINNER, seed=game_seed).game()
+    for player in players:
+        del player.get_play
+    return decisions
+
+
+def argmax_play(player, legal_plays):
+    choice_weights = np.where(bits_to_array(legal_plays), player.play_weights, -np.inf)
+    return Spades.CARD_BANK[np.argmax(choice_weights)]
+
+
+def precomputed_play(player, legal_plays):
+    for card in player.play_order:
+        if card.bit & legal_plays:
+            return card
+
+
+def decisions_per_sec(decisions, choose, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for player, legal_plays in decisions:
+            choose(player, legal_plays)
+        best = min(best, time.perf_counter() - start)
+    return len(decisions) / best
+
+
+def main(num_games=20, max_rounds=25, num_bids=100000, repeats=3, seed=0):
+    """
+    Replays the play decisions of num_games games between constant weight agents, choosing each card
+    with the masked argmax over the play weights and with the precomputed order of preference,
+    and times num_bids bids made with argmax and with the precomputed Bid
+    The card is only chosen, not played, so both are timed on the same hands
+    """
+    players = [ConstantWeightsGenetic(rng=np.random.default_rng(seed + i)) for i in range(Spades.NUM_PLAYERS)]
+    decisions = record_legal_plays(players, num_games, max_rounds, seed)
+    if any(argmax_play(player, legal_plays) is not precomputed_play(player, legal_plays) for player, legal_plays in decisions):
+        raise RuntimeError('the precomputed order of preference chose a different card than argmax')
+
+    player = players[0]
+    bids = [(player, None)] * num_bids
+    results = dict(
+        play_argmax=decisions_per_sec(decisions, argmax_play, repeats),
+        play_precomputed=decisions_per_sec(decisions, precomputed_play, repeats),
+        bid_argmax=decisions_per_sec(bids, lambda player, _: Bid(np.argmax(player.bid_weights)), repeats),
+        bid_precomputed=decisions_per_sec(bids, lambda player, bid_state: player.get_bid(bid_state), repeats),
+    )
+    logger.info('Decisions per sec', num_play_decisions=len(decisions), **{key: round(rate) for key, rate in results.items()})
+    return results
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
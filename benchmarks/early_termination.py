@@ -0,0 +1,47 @@
+import os, sys
+import fire
+import numpy as np
+
+p = os.path.abspath('.')
+sys.path.append(p)
+from util import get_logger
+from cards import Card
+from spades import Spades, EarlyTermination
+from batch_spades import BatchSpades
+from ai_agents.genetic import ConstantWeightsGenetic
+
+
+logger = get_logger('analysis')
+
+
+def main(num_games=2000, max_rounds=25, lead_rounds=10, seed=0):
+    """
+    Plays the same deals between constant weight agents with random play weights and the default bid under every early termination policy,
+    and reports the rounds each policy saved, how many games it gave a winner,
+    and how often that winner matches the winner of the game played out in full
+    """
+    rng = np.random.default_rng(seed)
+    bids = np.full((num_games, Spades.NUM_PLAYERS), np.argmax(ConstantWeightsGenetic.DEFAULT_BID_WEIGHTS))
+    play_weights = rng.random((num_games, Spades.NUM_PLAYERS, Card.CARD_LEN))
+    decks = BatchSpades(bids, play_weights, max_rounds=max_rounds).deal(rng)
+
+    stats = dict()
+    for policy in EarlyTermination:
+        results = BatchSpades(bids, play_weights, max_rounds=max_rounds, early_termination=policy, lead_rounds=lead_rounds).game(decks=decks)
+        if policy == EarlyTermination.NONE:
+            full_results = results
+        decided = results['winning_team'] != -1
+        both_decided = decided & (full_results['winning_team'] != -1)
+        stats[policy.name] = dict(
+            rounds=int(results['rounds'].sum()),
+            rounds_saved=int(full_results['rounds'].sum() - results['rounds'].sum()),
+            ended_early=int(results['ended_early'].sum()),
+            decided=int(decided.sum()),
+            same_winner=float(np.mean(results['winning_team'][both_decided] == full_results['winning_team'][both_decided])),
+        )
+        logger.info('Early termination', policy=policy.name, num_games=num_games, **stats[policy.name])
+    return stats
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,48 @@
+import os, sys
+import time
+import logging
+import fire
+import numpy as np
+import structlog
+
+p = os.path.abspath('.')
+sys.path.append(p)
+from util import get_logger, set_log_level
+from spades import Spades, ResultDetail
+from agent import DummyAgent, GreedyAgent
+from ai_agents.genetic import ConstantWeightsGenetic
+
+
+logger = get_logger('analysis')
+
+
+def games_per_sec(num_games, max_rounds, seed):
+    """
+    Plays num_games single-process games with the engine at its current log level
+    """
+    players = [GreedyAgent(), ConstantWeightsGenetic(rng=np.random.default_rng(seed)), DummyAgent(), ConstantWeightsGenetic(rng=np.random.default_rng(seed + 1))]
+    start = time.perf_counter()
+    for game_seed in np.random.SeedSequence(seed).spawn(num_games):
+        Spades(players, max_rounds=max_rounds, result_detail=ResultDetail.WINNER, seed=game_seed).game()
+    return num_games / (time.perf_counter() - start)
+
+
+def main(num_games=50, max_rounds=25, seed=0):
+    """
+    Compares engine throughput with logging at INFO and at DEBUG.
+    Debug output is rendered as usual but written to os.devnull.
+    """
+    with open(os.devnull, 'w') as devnull:
+        structlog.configure(logger_factory=structlog.PrintLoggerFactory(file=devnull))
+        results = dict()
+        for level in (logging.INFO, logging.DEBUG):
+            set_log_level(level, 'engine')
+            results[logging.getLevelName(level)] = games_per_sec(num_games, max_rounds, seed)
+        structlog.reset_defaults()
+    set_log_level(logging.INFO)
+    logger.info('Engine throughput by log level', num_games=num_games, games_per_sec_info=results['INFO'], games_per_sec_debug=results['DEBUG'])
+    return results
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,61 @@
+import os, sys
+import time
+import tempfile
+import fire
+import numpy as np
+
+p = os.path.abspath('.')
+sys.path.append(p)
+from util import get_logger
+from spades import Spades, ResultDetail
+from ai_agents.genetic import ConstantWeightsGenetic
+from records import GameRecordWriter, GameRecords
+
+
+logger = get_logger('analysis')
+
+
+def play_games(players, num_games, max_rounds, seed):
+    return [Spades(players, max_rounds=max_rounds, result_detail=ResultDetail.FULL, seed=game_seed).game()
+            for game_seed in np.random.SeedSequence(seed).spawn(num_games)]
+
+
+def main(num_games=200, max_rounds=25, seed=0):
+    """
+    Records num_games games between constant weight agents, then reconstructs their full histories
+    by replaying the records and by simulating the games again from their seeds, and compares the two
+    """
+    players = [ConstantWeightsGenetic(rng=np.random.default_rng(seed + i)) for i in range(Spades.NUM_PLAYERS)]
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'games')
+        writer = GameRecordWriter(path)
+        for results in play_games(players, num_games, max_rounds, seed):
+            writer.append(results)
+        writer.close()
+        record_bytes = os.path.getsize(f'{path}.games') + os.path.getsize(f'{path}.rounds')
+
+        start = time.perf_counter()
+        simulated = play_games(players, num_games, max_rounds, seed)
+        simulate_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        records = GameRecords(path)
+        replayed = records.replay()
+        replay_time = time.perf_counter() - start
+
+        for game, replay in zip(simulated, replayed):
+            if any(not np.array_equal(game[key], replay[key]) for key in ('scores', 'bids', 'tricks', 'cards_played')):
+                raise RuntimeError('a replayed game does not match its simulation')
+
+        results = dict(
+            simulate_games_per_sec=num_games / simulate_time,
+            replay_games_per_sec=num_games / replay_time,
+            bytes_per_game=record_bytes / num_games,
+            bytes_per_round=record_bytes / len(records.rounds),
+        )
+    logger.info('Replay', num_games=num_games, **{key: round(value, 1) for key, value in results.items()})
+    return results
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -0,0 +1,168 @@
+import os, sys
+import time
+import platform
+import subprocess
+import tempfile
+import fire
+import ujson
+import numpy as np
+
+p = os.path.abspath('.')
+sys.path.append(p)
+from util import get_logger
+from spades import Spades, GamePool, ResultDetail, play_n_games
+from agent import DummyAgent, GreedyAgent
+from ai_agents.genetic import ConstantWeightsGenetic
+
+
+"""
+Repeatable benchmark scenarios for the engine and for training.
+Every scenario is seeded, and the results are written to a JSON file along with the commit they were measured at,
+so that runs from different commits can be compared.
+"""
+
+
+logger = get_logger('analysis')
+
+AGENT_TYPES = dict(dummy=DummyAgent, greedy=GreedyAgent, cwg=ConstantWeightsGenetic)
+
+
+def make_players(agent_type, seed):
+    if agent_type == 'cwg':
+        return [ConstantWeightsGenetic(rng=np.random.default_rng(seed + i)) for i in range(Spades.NUM_PLAYERS)]
+    return [AGENT_TYPES[agent_type]() for _ in range(Spades.NUM_PLAYERS)]
+
+
+def best_of(repeats, fn):
+    """
+    Returns the shortest of repeats timed runs of fn, which is the least disturbed by the rest of the machine
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def games_per_sec(num_games, max_rounds, seed, repeats):
+    """
+    Single-process games/sec with 4 players of each agent type
+    """
+    results = dict()
+    for agent_type in AGENT_TYPES:
+        players = make_players(agent_type, seed)
+
+        def play():
+            for game_seed in np.random.SeedSequence(seed).spawn(num_games):
+                Spades(players, max_rounds=max_rounds, result_detail=ResultDetail.WINNER, seed=game_seed).game()
+        results[agent_type] = num_games / best_of(repeats, play)
+    return results
+
+
+def get_play_latency(num_games, max_rounds, seed):
+    """
+    Mean microseconds per get_play call of each agent type, timed inside real games
+    """
+    results = dict()
+    for agent_type in AGENT_TYPES:
+        players = make_players(agent_type, seed)
+        timing = dict(calls=0, seconds=0.0)
+        for player in players:
+            def timed_get_play(*args, get_play=player.get_play):
+                start = time.perf_counter()
+                card = get_play(*args)
+                timing['seconds'] += time.perf_counter() - start
+                timing['calls'] += 1
+                return card
+            player.get_play = timed_get_play
+        for game_seed in np.random.SeedSequence(seed).spawn(num_games):
+            Spades(players, max_rounds=max_rounds, result_detail=ResultDetail.WINNER, seed=game_seed).game()
+        results[agent_type] = timing['seconds'] / timing['calls'] * 1e6
+    return results
+
+
+def round_cost(num_rounds, seed, repeats):
+    """
+    Milliseconds per Spades.round with 4 players of each agent type
+    """
+    results = dict()
+    for agent_type in AGENT_TYPES:
+        players = make_players(agent_type, seed)
+
+        def play():
+            game = Spades(players, max_rounds=num_rounds, result_detail=ResultDetail.WINNER, seed=seed)
+            for _ in range(num_rounds):
+                game.round()
+        results[agent_type] = best_of(repeats, play) / num_rounds * 1e3
+    return results
+
+
+def pool_scaling(num_games, max_rounds, seed, core_counts, serial_games_per_sec):
+    """
+    games/sec of play_n_games on an already started GamePool for each core_count,
+    and its efficiency compared to core_count single-process engines, which measures the IPC overhead
+    """
+    players = make_players('cwg', seed)
+    results = dict()
+    for core_count in core_counts:
+        with GamePool(core_count, seed=seed) as pool:
+            play_n_games(players, core_count, max_rounds=max_rounds, pool=pool, seed=seed)  # start up every worker first
+            start = time.perf_counter()
+            play_n_games(players, num_games, max_rounds=max_rounds, pool=pool, seed=seed)
+            rate = num_games / (time.perf_counter() - start)
+        results[str(core_count)] = dict(games_per_sec=rate, efficiency=rate / (core_count * serial_games_per_sec))
+    return results
+
+
+def generations_per_hour(num_generations, seed, core_count, **train_kwargs):
+    """
+    Training generations/hour of a small run on the worker pool and on the batch engine, including the pool's start up
+    """
+    results = dict()
+    for batch_engine in (False, True):
+        with tempfile.TemporaryDirectory() as output_folder:
+            start = time.perf_counter()
+            ConstantWeightsGenetic.train(num_generations=num_generations, num_validation_games=1, output_folder=output_folder,
+                                         core_count=core_count, seed=seed, batch_engine=batch_engine, **train_kwargs)
+            results['batch_engine' if batch_engine else 'pool'] = num_generations * 3600 / (time.perf_counter() - start)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                numpy=np.__version__, machine=platform.machine(), cpu_count=os.cpu_count())
+
+
+def main(output='benchmark_results.json', num_games=50, max_rounds=25, num_rounds=200, pool_games=200, core_counts=(1, 2, 4),
+         num_generations=3, repeats=3, seed=0):
+    """
+    Runs every scenario and writes the results, with the parameters and environment they were measured in, to output as JSON
+    """
+    results = dict(environment=environment(), parameters=dict(
+        num_games=num_games, max_rounds=max_rounds, num_rounds=num_rounds, pool_games=pool_games,
+        core_counts=list(core_counts), num_generations=num_generations, repeats=repeats, seed=seed,
+    ))
+    results['games_per_sec'] = games_per_sec(num_games, max_rounds, seed, repeats)
+    logger.info('Benchmark', scenario='games_per_sec', **results['games_per_sec'])
+    results['get_play_us'] = get_play_latency(num_games, max_rounds, seed)
+    logger.info('Benchmark', scenario='get_play_us', **results['get_play_us'])
+    results['round_ms'] = round_cost(num_rounds, seed, repeats)
+    logger.info('Benchmark', scenario='round_ms', **results['round_ms'])
+    results['pool_scaling'] = pool_scaling(pool_games, max_rounds, seed, core_counts, results['games_per_sec']['cwg'])
+    logger.info('Benchmark', scenario='pool_scaling', **results['pool_scaling'])
+    results['generations_per_hour'] = generations_per_hour(num_generations, seed, max(core_counts))
+    logger.info('Benchmark', scenario='generations_per_hour', **results['generations_per_hour'])
+
+    with open(output, 'w') as f:
+        ujson.dump(results, f, indent=4)
+    logger.info('Saved benchmark results', output=output)
+    return results
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
@@ -1,5 +1,6 @@
 import numpy as np
 from enum import IntEnum
+from operator import attrgetter
 
 from util import get_first_one_2d
 
@@ -34,18 +35,43 @@ CARD_MAP = {
 }
 
 
+SUIT_BITS = {suit: ((1 << 13) - 1) << (13 * suit) if suit >= 0 else 0 for suit in Suits}  # Hand bitboard mask of each suit
+NON_SPADES_BITS = SUIT_BITS[Suits.CLUBS] | SUIT_BITS[Suits.DIAMONDS] | SUIT_BITS[Suits.HEARTS]
+
+
+def bits_to_array(bits):
+    """
+    Converts a bitboard of cards to a (1, 52) boolean array
+    """
+    as_bytes = np.frombuffer(bits.to_bytes(7, 'little'), dtype=np.uint8)
+    return np.unpackbits(as_bytes, count=Card.CARD_LEN, bitorder='little').astype(bool).reshape((1, Card.CARD_LEN))
+
+
 class Bid:
+    """
+    Bids are interned: Bid(value) returns the one immutable Bid of that value from Bid.BANK,
+    so bids compare by identity and no Bid is ever built during a game
+    """
     MIN_BID = 0
     MAX_BID = 13
     BID_LEN = 14  # 14 possible values, so array is 14 elements long
+    __slots__ = ('value', 'array')
 
-    def __init__(self, value):
+    def __new__(cls, value):
         if value < Bid.MIN_BID - 1 or value > Bid.MAX_BID:
             raise AttributeError("Bid() argument 'value' out of valid range [0, 13]")
-        self.array = np.zeros((1, Bid.BID_LEN))
-        self.value = value
+        return Bid.BANK[value + 1]
+
+    @classmethod
+    def _build(cls, value):
+        bid = object.__new__(cls)
+        array = np.zeros((1, Bid.BID_LEN))  # the (1, 14) one-hot vector of the bid
         if value > -1:
-            self.array[0, value] = 1
+            array[0, value] = 1
+        array.flags.writeable = False
+        object.__setattr__(bid, 'value', value)
+        object.__setattr__(bid, 'array', array)
+        return bid
 
     @classmethod
     def from_array(cls, array):
@@ -76,12 +102,18 @@ class Bid:
             return 'X'
         return str(self.value)
 
-    # Comparison operators
-    def __eq__(self, other):
-        return self.value == other.value
+    def __setattr__(self, name, value):
+        raise AttributeError("Bid objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Bid objects are immutable")
 
-    def __ne__(self, other):
-        return self.value != other.value
+    def __reduce__(self):
+        return Bid, (self.value,)  # unpickles to the interned bid
+
+    # Comparison operators; equality is identity, since there is only one bid of each value
+    def __hash__(self):
+        return self.value
 
     def __lt__(self, other):
         return self.value < other.value
@@ -96,17 +128,36 @@ class Bid:
         return self.value >= other.value
 
 
+Bid.BANK = tuple(Bid._build(value) for value in range(Bid.MIN_BID - 1, Bid.MAX_BID + 1))
+
+
 class Card:
+    """
+    Cards are interned: Card(value) returns the one immutable Card of that value from Card.BANK,
+    so cards compare by identity and hash by value
+    """
     CARD_LEN = 52  # 52 possible values, so array is 52 elements long
     SUIT_LEN = 13  # 13 cards in each suit
+    __slots__ = ('value', 'bit', 'suit_index', '_suit', 'array')
 
-    def __init__(self, value):
+    def __new__(cls, value):
         if value < -1 or value > Card.CARD_LEN - 1:
             raise AttributeError("Card() argument 'value' out of valid range [-1, 51]")
-        self.array = np.zeros((1, Card.CARD_LEN))
-        self.value = value
+        return Card.BANK[value + 1]
+
+    @classmethod
+    def _build(cls, value):
+        card = object.__new__(cls)
+        array = np.zeros((1, Card.CARD_LEN))  # the (1, 52) one-hot vector of the card
         if value > -1:
-            self.array[0, value] = 1
+            array[0, value] = 1
+        array.flags.writeable = False
+        object.__setattr__(card, 'value', value)
+        object.__setattr__(card, 'bit', 1 << value if value > -1 else 0)  # position of the card in a Hand bitboard
+        object.__setattr__(card, 'suit_index', value // Card.SUIT_LEN)
+        object.__setattr__(card, '_suit', Suits(value // Card.SUIT_LEN))
+        object.__setattr__(card, 'array', array)
+        return card
 
     @classmethod
     def from_array(cls, array):
@@ -123,28 +174,28 @@ class Card:
             raise TypeError("from_array() argument 'array' is missing or invalid type")
 
     def suit(self) -> Suits:
-        return Suits(self.value // Card.SUIT_LEN)
+        return self._suit
 
     def is_better(self, other):
-        if self.suit() == other.suit():
+        if self.suit_index == other.suit_index:
             return self.value % Card.SUIT_LEN > other.value % Card.SUIT_LEN
         else:
-            return self.suit() == Suits['SPADES']
+            return self.suit_index == Suits.SPADES
 
     def is_valid_play(self, hand, spades_broken, first_card=None, check_hand=False):
         """
         check_hand: if False, won't see if the card was in the hand
         """
-        if check_hand and not hand.has_card(self):  # can't play a card you don't have
+        if check_hand and not hand.bits & self.bit:  # can't play a card you don't have
             return False
 
         if first_card is None:  # first_card should be None if this one is the first card played in the turn
-            return self.suit() != Suits['SPADES'] or spades_broken or not any(hand.has_suit(suit) for suit in [Suits['CLUBS'], Suits['DIAMONDS'], Suits['HEARTS']])
+            return self.suit_index != Suits.SPADES or spades_broken or not hand.bits & NON_SPADES_BITS
 
-        if self.suit() == first_card.suit():
+        if self.suit_index == first_card.suit_index:
             return True
 
-        return not hand.has_suit(first_card.suit())
+        return not hand.bits & SUIT_BITS[first_card.suit_index]
 
     @staticmethod
     def list_to_np(cards, n=13):
@@ -159,18 +210,23 @@ class Card:
     def __repr__(self):
         if self.value == -1:
             return 'Blank Card'
-        suit = str(self.suit())  # 'Suits.SUIT'
-        suit = suit.split('.')[1]  # 'SUIT'
+        suit = self.suit().name  # 'SUIT'
         suit = suit[0] + suit[1:].lower()  # 'Suit'
         name = CARD_MAP[self.value % 13]
         return f'{name} of {suit}'
 
-    # Comparison operators
-    def __eq__(self, other):
-        return self.value == other.value
+    def __setattr__(self, name, value):
+        raise AttributeError("Card objects are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Card objects are immutable")
 
-    def __ne__(self, other):
-        return self.value != other.value
+    def __reduce__(self):
+        return Card, (self.value,)  # unpickles to the interned card
+
+    # Comparison operators; equality is identity, since there is only one card of each value
+    def __hash__(self):
+        return self.value
 
     def __lt__(self, other):
         return self.value < other.value
@@ -185,34 +241,72 @@ class Card:
         return self.value >= other.value
 
 
+Card.BANK = tuple(Card._build(value) for value in range(-1, Card.CARD_LEN))
+
+
 class Hand:
+    """
+    A hand of cards, stored as a 52-bit integer with bit i set if card i is held.
+    The list of cards is kept alongside it for indexing in sorted order.
+    """
     HAND_LEN = 13  # 13 cards in a hand
 
     def __init__(self):
-        self.array = np.zeros((1, Card.CARD_LEN))
+        self.bits = 0
         self.cards = list()
 
+    @classmethod
+    def from_cards(cls, cards):
+        """
+        Initializes a Hand holding the given distinct cards
+        """
+        hand = cls()
+        hand.cards = list(cards)
+        for card in hand.cards:
+            hand.bits |= card.bit
+        if hand.bits.bit_count() != len(hand.cards):
+            raise AttributeError("from_cards() argument 'cards' has a repeated card")
+        return hand
+
+    @property
+    def array(self):
+        """
+        The (1, 52) array with a one for every card in the hand, built on demand
+        """
+        return bits_to_array(self.bits).astype(float)
+
     def deal(self, card):
-        if card not in self.cards:
-            self.cards.append(card)
-            self.array[0, card.value] = 1
-        else:
+        if self.bits & card.bit:
             raise AttributeError("deal() argument 'card' was already in this hand")
+        self.cards.append(card)
+        self.bits |= card.bit
 
     def sort(self):
-        self.cards = sorted(self.cards)
+        self.cards.sort(key=attrgetter('value'))
 
     def has_card(self, card):
-        return card in self.cards
+        return bool(self.bits & card.bit)
 
     def has_suit(self, suit):
-        return any(card.suit() == suit for card in self.cards)
+        return bool(self.bits & SUIT_BITS[suit])
+
+    def legal_plays(self, spades_broken, first_card=None):
+        """
+        Returns the bitboard of the cards in the hand that may be played
+        first_card should be None if the play leads the turn
+        """
+        if first_card is None:
+            if spades_broken or not self.bits & NON_SPADES_BITS:
+                return self.bits
+            return self.bits & NON_SPADES_BITS  # spades can't be led until broken
+        following = self.bits & SUIT_BITS[first_card.suit_index]
+        return following if following else self.bits
 
     def play_card(self, card):
-        if not self.has_card(card):
+        if not self.bits & card.bit:
             raise AttributeError("play_card() argument 'card' is not in this hand")
         self.cards.remove(card)
-        self.array[0, card.value] = 0
+        self.bits &= ~card.bit
         return card
 
     def __len__(self):
@@ -0,0 +1,189 @@
+import json
+import os
+import re
+import threading
+import fire
+import numpy as np
+
+from cards import Bid, Card
+from util import get_logger, complete_records
+
+
+"""
+Implements saving the full state of a training run after each generation, so that it can be resumed,
+and the checkpoint store that keeps the best agent of every generation of a run in a single file.
+"""
+
+
+TRAINING_STATE_FILE = 'training_state.npz'
+CHECKPOINT_STORE_FILE = 'checkpoints.bin'
+CHECKPOINT_DTYPE = np.dtype([
+    ('generation', '<i8'),
+    ('wins', '<i8'),
+    ('games_played', '<i8'),
+    ('bid_weights', '<f8', (Bid.BID_LEN,)),
+    ('play_weights', '<f8', (Card.CARD_LEN,)),
+])
+LEGACY_CHECKPOINT_PATTERN = re.compile(r'(?:.*__)?(bid|play)_weights_checkpoint_(\d+)$')  # older runs prefix the agent name
+
+logger = get_logger('training')
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread, so that saving never stalls training.
+    Each checkpoint is written to a temporary file and renamed over the previous one,
+    so an interrupted write never leaves a partial checkpoint behind.
+    Only one write is in flight at a time; a new save first waits for the previous one to finish.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, path, **arrays):
+        """
+        Starts writing the arrays to an .npz file at path; the arrays must not be modified until the write finishes
+        """
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(path, arrays), daemon=True)
+        self.thread.start()
+
+    def write(self, path, arrays):
+        temp_path = f'{path}.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                np.savez(f, **arrays)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Blocks until the write in flight finishes, and raises any error it ran into
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def save_training_state(writer: CheckpointWriter, output_folder, generation: int, population, fitness, rng, seed_seq, game_seed):
+    """
+    Saves everything needed to resume training at the given generation in the background:
+    the whole population, the last generation's tallies, the state of the trainer's rng and the seeds of the run
+    """
+    meta = dict(
+        generation=generation,
+        rng_state=rng.bit_generator.state,
+        seed=str(seed_seq.entropy),
+        game_seeds_spawned=game_seed.n_children_spawned,
+    )
+    writer.save(
+        os.path.join(output_folder, TRAINING_STATE_FILE),
+        meta=np.array(json.dumps(meta)),
+        bid_weights=population.bid_weights.copy(),
+        play_weights=population.play_weights.copy(),
+        wins=fitness.wins.copy(),
+        score_margin=fitness.score_margin.copy(),
+        games_played=fitness.games_played.copy(),
+    )
+
+
+def load_training_state(output_folder):
+    """
+    Returns the training state saved in output_folder as a dict, with the 'seed' entropy as an int
+    """
+    path = os.path.join(output_folder, TRAINING_STATE_FILE)
+    if not os.path.exists(path):
+        raise AttributeError(f"no training state to resume from in {output_folder}")
+    with np.load(path) as checkpoint:
+        state = {key: checkpoint[key] for key in checkpoint.files if key != 'meta'}
+        state.update(json.loads(str(checkpoint['meta'])))
+    state['seed'] = int(state['seed'])
+    return state
+
+
+class CheckpointStore:
+    """
+    An append-only file of fixed-size CHECKPOINT_DTYPE records, one per checkpointed generation in increasing order,
+    each holding the best agent's tallies and weights.
+    Readers memory-map the file, so any range of generations is a slice of a single array.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def in_folder(cls, output_folder):
+        return cls(os.path.join(output_folder, CHECKPOINT_STORE_FILE))
+
+    def append(self, generation: int, wins: int, games_played: int, bid_weights, play_weights):
+        record = np.zeros(1, dtype=CHECKPOINT_DTYPE)
+        record['generation'] = generation
+        record['wins'] = wins
+        record['games_played'] = games_played
+        record['bid_weights'] = np.reshape(bid_weights, Bid.BID_LEN)
+        record['play_weights'] = np.reshape(play_weights, Card.CARD_LEN)
+        with open(self.path, 'ab') as f:
+            f.write(record.tobytes())
+
+    def truncate(self, generation: int):
+        """
+        Drops the records of the given generation and every later one, such as those of a run being restarted or resumed
+        """
+        if os.path.exists(self.path):
+            keep = np.searchsorted(self.records()['generation'], generation)
+            os.truncate(self.path, keep * CHECKPOINT_DTYPE.itemsize)
+
+    def records(self):
+        """
+        Returns every record as a read-only memory-mapped array; a partially written last record is ignored
+        """
+        return complete_records(self.path, CHECKPOINT_DTYPE)
+
+    def generations(self, start: int = 0, stop: int = None):
+        """
+        Returns the records of the generations in [start, stop)
+        """
+        records = self.records()
+        first, last = np.searchsorted(records['generation'], [start, stop if stop is not None else np.iinfo(np.int64).max])
+        return records[first:last]
+
+
+def import_output_folder(output_folder):
+    """
+    Builds the checkpoint store of an output folder written before the store existed,
+    from its bid_weights_checkpoint_N, play_weights_checkpoint_N and stats_checkpoint_N.txt files
+    """
+    weight_files = dict()
+    for file_name in os.listdir(output_folder):
+        match = LEGACY_CHECKPOINT_PATTERN.match(file_name)
+        if match is not None:
+            weight_files[match.group(1), int(match.group(2))] = os.path.join(output_folder, file_name)
+
+    store = CheckpointStore.in_folder(output_folder)
+    store.truncate(0)
+    generations = sorted(gen for kind, gen in weight_files if kind == 'play' and ('bid', gen) in weight_files)
+    for gen in generations:
+        wins, games_played = 0, 0
+        stats_file = os.path.join(output_folder, f'stats_checkpoint_{gen}.txt')
+        if os.path.exists(stats_file):
+            with open(stats_file) as f:
+                wins, games_played = (int(count) for count in f.read().split(':')[1].split('/'))
+        store.append(gen, wins, games_played, np.load(weight_files['bid', gen]), np.load(weight_files['play', gen]))
+    logger.info('Imported checkpoints', output_folder=output_folder, num_checkpoints=len(generations))
+    return store
+
+
+def import_output_folders(*output_folders):
+    for output_folder in output_folders:
+        import_output_folder(output_folder)
+
+
+if __name__ == '__main__':
+    fire.Fire(import_output_folders)
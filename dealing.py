@@ -0,0 +1,84 @@
+import fire
+import numpy as np
+
+from cards import Card, Hand
+from util import as_seed_sequence, get_logger
+
+
+"""
+Implements dealing from shuffled decks that are generated in bulk.
+A shuffled deck is a permutation of the 52 card values, and hand i is dealt positions [13i, 13i + 13) of it.
+"""
+
+
+NUM_HANDS = 4
+
+logger = get_logger('engine')
+
+DEAL_BANKS = dict()  # deal banks already opened by this process, by path
+
+
+def shuffled_decks(rng, num_decks):
+    """
+    Returns a (num_decks, 52) int8 array of independent random permutations of the deck
+    """
+    decks = np.broadcast_to(np.arange(Card.CARD_LEN, dtype=np.int8), (num_decks, Card.CARD_LEN))
+    return rng.permuted(decks, axis=1)
+
+
+def split_hands(decks):
+    """
+    Splits (..., 52) shuffled decks into (..., 4, 13) hands, each sorted by card value
+    """
+    return np.sort(decks.reshape(decks.shape[:-1] + (NUM_HANDS, Hand.HAND_LEN)), axis=-1)
+
+
+def make_deal_bank(path, num_deals: int = 100000, seed: int = None):
+    """
+    Saves num_deals shuffled decks to a .npy deal bank file, so that evaluations can reuse the exact same deals
+    """
+    seed_seq = as_seed_sequence(seed)
+    np.save(path, shuffled_decks(np.random.default_rng(seed_seq), num_deals))
+    logger.info('Saved deal bank', path=path, num_deals=num_deals, seed=seed_seq.entropy)
+
+
+def load_deal_bank(path):
+    """
+    Returns the (num_deals, 52) decks of a deal bank file, memory-mapped and opened once per process
+    """
+    if path not in DEAL_BANKS:
+        decks = np.load(path, mmap_mode='r')
+        if decks.ndim != 2 or decks.shape[1] != Card.CARD_LEN:
+            raise AttributeError(f"deal bank must hold a (num_deals, {Card.CARD_LEN}) array")
+        DEAL_BANKS[path] = decks
+    return DEAL_BANKS[path]
+
+
+class Dealer:
+    """
+    Hands out deals one at a time as (4, 13) arrays of sorted card values.
+    Deals come from a deal bank in order (wrapping around) starting at offset if one is given,
+    otherwise from batches of batch_size decks shuffled at once with rng.
+    """
+
+    def __init__(self, rng=None, batch_size: int = 16, bank=None, offset: int = 0):
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.batch_size = batch_size
+        self.bank = load_deal_bank(bank) if isinstance(bank, str) else bank
+        self.position = offset
+        self.hands = np.zeros((0, NUM_HANDS, Hand.HAND_LEN), dtype=np.int8)
+
+    def next_deal(self):
+        if self.bank is not None:
+            hands = split_hands(np.asarray(self.bank[self.position % len(self.bank)]))
+        else:
+            if self.position >= len(self.hands):
+                self.hands = split_hands(shuffled_decks(self.rng, self.batch_size))
+                self.position = 0
+            hands = self.hands[self.position]
+        self.position += 1
+        return hands
+
+
+if __name__ == '__main__':
+    fire.Fire(make_deal_bank)
@@ -0,0 +1,128 @@
+import numpy as np
+from statistics import NormalDist
+
+from spades import duplicate_variance_reduction
+
+
+class FitnessAggregator:
+    """
+    Streams game results into running tallies of each agent's wins, score margin and games played.
+    Agents are identified by their index in the population, and each result's 'pid' must hold
+    the population index of the agent in each seat.
+    Results may arrive in any order, as they finish.
+    """
+
+    def __init__(self, population_size: int):
+        self.population_size = population_size
+        self.reset()
+
+    def reset(self):
+        self.wins = np.zeros(self.population_size, dtype=int)
+        self.score_margin = np.zeros(self.population_size, dtype=int)
+        self.games_played = np.zeros(self.population_size, dtype=int)
+        self.num_margins = np.zeros(self.population_size, dtype=int)  # games or duplicate pairs with a known score margin
+        self.margin_squares = np.zeros(self.population_size)  # for the spread of the margins, when racing
+        self.pair_margins = []  # score margins of every duplicate pair, for measuring the variance reduction
+
+    def update(self, results):
+        """
+        Adds the results of one game (or duplicate pair) to the tallies of the agents that played it
+        """
+        seats = results['pid']
+        if 'team_wins' in results:
+            margin = sum(results['margins'])
+            self.pair_margins.append(results['margins'])
+            for team in range(2):
+                for seat in (team, team + 2):
+                    self.wins[seats[seat]] += results['team_wins'][team]
+                    self.score_margin[seats[seat]] += margin if team == 0 else -margin
+                    self.games_played[seats[seat]] += 2
+                    self.num_margins[seats[seat]] += 1
+                    self.margin_squares[seats[seat]] += margin ** 2
+            return
+
+        for seat in seats:
+            self.games_played[seat] += 1
+        if results.get('winning_players') is not None:
+            for seat in results['winning_players']:
+                self.wins[seats[seat]] += 1
+        if results.get('final_scores') is not None:
+            margin = int(results['final_scores'][0] - results['final_scores'][1])
+            for team in range(2):
+                for seat in (team, team + 2):
+                    self.score_margin[seats[seat]] += margin if team == 0 else -margin
+                    self.num_margins[seats[seat]] += 1
+                    self.margin_squares[seats[seat]] += margin ** 2
+
+    def win_rates(self):
+        return self.wins / np.maximum(self.games_played, 1)
+
+    def mean_margins(self):
+        """
+        Returns each agent's mean score margin per game
+        """
+        return self.score_margin / np.maximum(self.games_played, 1)
+
+    def confidence_bounds(self, by: str, z: float):
+        """
+        Returns the lower and upper bounds of each agent's 'win_rate' or 'mean_margin', z standard errors either side:
+        the Wilson interval of the win rate, and the normal interval of the mean margin
+        Agents without any games have infinite bounds
+        """
+        if by == 'win_rate':
+            n = np.maximum(self.games_played, 1)
+            p = self.win_rates()
+            center = (p + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+            half_width = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+        else:
+            # every game or duplicate pair is one sample of the margin, spread over the games it took
+            n = np.maximum(self.num_margins, 1)
+            sample_mean = self.score_margin / n
+            sample_var = np.maximum(self.margin_squares / n - sample_mean ** 2, 0) * n / np.maximum(n - 1, 1)
+            center = self.mean_margins()
+            half_width = z * np.sqrt(sample_var / n) * n / np.maximum(self.games_played, 1)
+        half_width = np.where(self.games_played > 0, half_width, np.inf)
+        return center - half_width, center + half_width
+
+    def survivors(self, active, select_number: int, by: str, confidence: float, num_looks: int):
+        """
+        Returns the active agents that may still be among the select_number fittest by 'win_rate' or 'mean_margin':
+        an agent is eliminated only when its upper confidence bound is below the lower bounds of select_number other active agents
+        The confidence holds jointly over every agent of the population at each of num_looks looks
+        """
+        z = NormalDist().inv_cdf(1 - (1 - confidence) / (2 * self.population_size * num_looks))
+        lower, upper = self.confidence_bounds(by, z)
+        boundary = np.sort(lower[active])[::-1][select_number - 1]
+        return active[upper[active] >= boundary]
+
+    def variance_reduction(self):
+        """
+        Returns the variance reduction achieved by the duplicate pairs seen so far (see duplicate_variance_reduction)
+        """
+        return duplicate_variance_reduction(self.pair_margins) if self.pair_margins else 0.0
+
+    def ranking(self, by: str = 'wins', rungs=None):
+        """
+        Returns the population indices from fittest to least fit, by 'wins', 'win_rate', 'score_margin' or 'mean_margin'
+        If the racing rung each agent reached is given, agents that reached a later rung rank first
+        Ties keep population order.
+        """
+        fitness = self.win_rates() if by == 'win_rate' else self.mean_margins() if by == 'mean_margin' else getattr(self, by)
+        if rungs is None:
+            return np.argsort(-fitness, kind='stable')
+        return np.lexsort((-fitness, -np.asarray(rungs)))
+
+
+def racing_schedule(games_per_gen: int, first_rounds: int):
+    """
+    Returns the number of rounds of each rung of racing over one generation, doubling at each rung as in successive halving:
+    first_rounds, then twice as many, and so on, until games_per_gen rounds have been played
+    """
+    schedule = []
+    num_rounds, rounds_played = first_rounds, 0
+    while rounds_played < games_per_gen:
+        num_rounds = min(num_rounds, games_per_gen - rounds_played)
+        schedule.append(num_rounds)
+        rounds_played += num_rounds
+        num_rounds *= 2
+    return schedule
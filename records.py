@@ -0,0 +1,172 @@
+import glob
+import os
+import fire
+import numpy as np
+
+from cards import Card, Hand
+from spades import Spades
+from batch_spades import CARD_SUITS, trick_winner_strength
+from util import get_logger, complete_records
+
+
+"""
+Implements a compact binary record of played games, written as a stream while games are played and memory-mapped for analysis.
+A record set is a pair of append-only files of fixed-size records, path.games with one GAME_DTYPE record per game
+and path.rounds with one ROUND_DTYPE record per round, where each game points to its run of consecutive rounds.
+A round's deck holds the cards each player played, in the order they played them: player i's 13 cards take positions [13i, 13i + 13).
+That is a shuffled deck in the layout dealing.py deals from, so it records the deal along with the play order,
+and the trick winners follow from it by the rules, so replaying a game never calls an agent.
+"""
+
+
+GAME_RECORDS_FOLDER = 'game_records'
+ROUND_DTYPE = np.dtype([
+    ('deck', 'i1', (Card.CARD_LEN,)),
+    ('bids', 'i1', (Spades.NUM_PLAYERS,)),
+    ('scores', '<i4', (2,)),  # running team scores at the end of the round
+])
+GAME_DTYPE = np.dtype([
+    ('first_round', '<i8'),  # index of the game's first round in path.rounds
+    ('num_rounds', '<i4'),
+    ('winning_team', 'i1'),  # -1 if the game exceeded max_rounds
+    ('ended_early', '?'),
+])
+
+logger = get_logger('engine')
+
+
+class GameRecordWriter:
+    """
+    Appends FULL detail game results to the record set at path.
+    Games are buffered in memory and written buffer_games at a time, so memory stays bounded however many games are recorded.
+    Rounds are written before the games that point to them, and opening a writer drops anything left over from an interrupted write,
+    so a reader never sees a game whose rounds are missing.
+    Only one writer may append to a record set at a time; parallel workers each write their own record set.
+    """
+
+    def __init__(self, path, buffer_games: int = 256):
+        self.path = path
+        self.buffer_games = buffer_games
+        games = complete_records(f'{path}.games', GAME_DTYPE)
+        self.num_rounds = int(games[-1]['first_round'] + games[-1]['num_rounds']) if len(games) else 0
+        for file_path, num_records, dtype in ((f'{path}.games', len(games), GAME_DTYPE), (f'{path}.rounds', self.num_rounds, ROUND_DTYPE)):
+            if os.path.exists(file_path):
+                os.truncate(file_path, num_records * dtype.itemsize)
+        self.games = []
+        self.rounds = []
+
+    def append(self, results):
+        """
+        Buffers one game from the results of a Spades game played with ResultDetail.FULL
+        """
+        num_rounds = results['rounds']
+        rounds = np.zeros(num_rounds, dtype=ROUND_DTYPE)
+        rounds['deck'] = results['cards_played'].transpose(0, 2, 1).reshape(num_rounds, Card.CARD_LEN)
+        rounds['bids'] = results['bids']
+        rounds['scores'] = results['scores'][1:]
+
+        game = np.zeros(1, dtype=GAME_DTYPE)
+        game['first_round'] = self.num_rounds
+        game['num_rounds'] = num_rounds
+        game['winning_team'] = results['winning_players'][0] if results['winning_players'] is not None else -1
+        game['ended_early'] = results['ended_early']
+
+        self.games.append(game)
+        self.rounds.append(rounds)
+        self.num_rounds += num_rounds
+        if len(self.games) >= self.buffer_games:
+            self.flush()
+
+    def flush(self):
+        if not self.games:
+            return
+        with open(f'{self.path}.rounds', 'ab') as f:
+            f.write(np.concatenate(self.rounds).tobytes())
+        with open(f'{self.path}.games', 'ab') as f:
+            f.write(np.concatenate(self.games).tobytes())
+        self.games = []
+        self.rounds = []
+
+    def close(self):
+        self.flush()
+
+
+def trick_winners(cards_played, round_numbers):
+    """
+    Returns the (R, 13) player ID that won each trick of R rounds, given their (R, 13, 4) cards played by player ID
+    and the number of each round within its game, which sets the player that leads its first trick
+    """
+    rows = np.arange(len(cards_played))
+    tricks = np.zeros(cards_played.shape[:2], dtype=np.int8)
+    starting_player = (round_numbers + 1) % Spades.NUM_PLAYERS  # the dealer moves one seat each round, starting from player 0
+    for trick in range(Hand.HAND_LEN):
+        played = cards_played[:, trick].astype(int)
+        lead_suit = CARD_SUITS[played[rows, starting_player]]
+        starting_player = np.argmax(trick_winner_strength(played, lead_suit), axis=1)
+        tricks[:, trick] = starting_player
+    return tricks
+
+
+class GameRecords:
+    """
+    Reads the record set at path, memory-mapped, as of when it was opened
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.games = complete_records(f'{path}.games', GAME_DTYPE)
+        self.rounds = complete_records(f'{path}.rounds', ROUND_DTYPE)
+
+    @classmethod
+    def in_folder(cls, folder):
+        """
+        Returns the record sets in folder, such as one per worker of a training run
+        """
+        return [cls(path[:-len('.games')]) for path in sorted(glob.glob(os.path.join(folder, '*.games')))]
+
+    def __len__(self):
+        return len(self.games)
+
+    def replay(self, indices=None):
+        """
+        Reconstructs the given games (every game by default) all at once, and returns a list of their results
+        in the same form as Spades.game with ResultDetail.FULL, apart from the seed, which is not recorded
+        """
+        games = self.games if indices is None else self.games[indices]
+        num_rounds = games['num_rounds'].astype(int)
+        game_starts = np.cumsum(num_rounds) - num_rounds
+        round_numbers = np.arange(num_rounds.sum()) - np.repeat(game_starts, num_rounds)
+        rounds = self.rounds[np.repeat(games['first_round'], num_rounds) + round_numbers]
+
+        cards_played = np.ascontiguousarray(rounds['deck'].reshape(-1, Spades.NUM_PLAYERS, Hand.HAND_LEN).transpose(0, 2, 1))
+        tricks = trick_winners(cards_played, round_numbers)
+
+        results = []
+        for game, start, length in zip(games, game_starts, num_rounds):
+            end = start + length
+            scores = np.zeros((length + 1, 2), dtype=np.int32)
+            scores[1:] = rounds['scores'][start:end]
+            winning_team = int(game['winning_team'])
+            results.append(dict(
+                winning_players=[winning_team, winning_team + 2] if winning_team != -1 else None,
+                final_scores=scores[-1],
+                rounds=int(length),
+                ended_early=bool(game['ended_early']),
+                scores=scores,
+                bids=rounds['bids'][start:end],
+                tricks=tricks[start:end],
+                cards_played=cards_played[start:end],
+            ))
+        return results
+
+
+def summarize(folder):
+    """
+    Logs the number of games and rounds recorded in each record set in folder
+    """
+    for records in GameRecords.in_folder(folder):
+        logger.info('Game records', path=records.path, num_games=len(records), num_rounds=len(records.rounds))
+
+
+if __name__ == '__main__':
+    fire.Fire(summarize)
@@ -1,21 +1,88 @@
 import queue
+import time
+import functools
 import multiprocessing
 import numpy as np
+from enum import IntEnum
 
 from cards import Bid, Card, Hand, Suits
-from util import get_first_card, get_first_one_2d, logger
+from util import as_seed_sequence, get_first_card, get_logger
 from agent import AgentBase
+from dealing import Dealer, load_deal_bank
 
 
+logger = get_logger('engine')
+
 BLANK_BID = Bid(-1)
 BLANK_CARD = Card(-1)
+BLANK_TRICK = (BLANK_CARD,) * 4  # the previous play of a round's first trick
+
+
+class ResultDetail(IntEnum):
+    """
+    How much of a finished game Spades.game returns; each level includes everything in the levels below it
+    """
+    WINNER = 0  # winning_players only
+    SUMMARY = 1  # adds final_scores, rounds, ended_early and the game seed
+    FULL = 2  # adds the scores, bids, tricks and cards_played histories as packed integer arrays
+
+
+class EarlyTermination(IntEnum):
+    """
+    When Spades.game may end a game whose winner is already decided, instead of playing on to win_points or max_rounds
+    The leading team is declared the winner, including of games that would otherwise have exceeded max_rounds
+    """
+    NONE = 0  # every game is played out
+    # once the trailing team could not catch up by max_rounds even with the best possible rounds; a round can swing
+    # the scores by hundreds of points, so in practice this almost never ends a game sooner and acts as a "leader wins at the cap" rule
+    UNCATCHABLE = 1
+    LEAD_AFTER = 2  # as soon as one team leads after lead_rounds rounds
+
+
+def max_round_swing(nil_points: int):
+    """
+    Returns the most that the score difference between the teams can change in one round:
+    one team makes either a 13 bid and a nil or two nils, while the other fails both of its nil bids and crosses 10 bags
+    """
+    max_gain = max(10 * Hand.HAND_LEN + nil_points, 2 * nil_points)
+    max_loss = max(2 * nil_points, nil_points + Hand.HAND_LEN) + 100
+    return max_gain + max_loss
+
+
+def decided_early(early_termination, rounds_played, scores, max_rounds: int, lead_rounds: int, nil_points: int):
+    """
+    Returns whether games with the given (..., 2) team scores after rounds_played rounds are decided under the early_termination policy
+    """
+    lead = np.abs(scores[..., 0] - scores[..., 1])
+    if early_termination == EarlyTermination.UNCATCHABLE:
+        return lead > (max_rounds - rounds_played) * max_round_swing(nil_points)
+    if early_termination == EarlyTermination.LEAD_AFTER:
+        return (rounds_played >= lead_rounds) & (lead > 0)
+    return np.zeros(lead.shape, dtype=bool)
+
+
+def out_of_time(start: float, time_budget: float = None):
+    """
+    Returns whether more than time_budget seconds have passed since the perf_counter time start; never if there is no budget
+    """
+    return time_budget is not None and time.perf_counter() - start > time_budget
 
 
 class Spades:
     NUM_PLAYERS = 4
-    CARD_BANK = [Card(i) for i in range(Card.CARD_LEN)]
+    CARD_BANK = Card.BANK[1:]  # indexed by card value
 
-    def __init__(self, players, *args, nil_points: int = 100, win_points: int = 500, max_rounds: int = 1000, **kwargs):
+    def __init__(self, players, *args, nil_points: int = 100, win_points: int = 500, max_rounds: int = 1000,
+                 result_detail: ResultDetail = ResultDetail.FULL, seed=None, deal_bank=None, deal_offset: int = 0,
+                 early_termination: EarlyTermination = EarlyTermination.NONE, lead_rounds: int = 10, time_budget: float = None, **kwargs):
+        """
+        seed (an int or np.random.SeedSequence) drives all of the game's randomness, so a game can be replayed from it
+        If a deal_bank (file path or array of shuffled decks) is given, rounds are dealt from it in order starting at deal_offset
+        early_termination sets when a decided game ends early (see EarlyTermination)
+        time_budget is the wall time in seconds a game may take: once a round finishes past it, the game ends early
+        and the leading team wins (no one, if the scores are tied). The result then depends on the machine's speed,
+        so a game with a time budget may not replay the same from its seed
+        """
         self.players = players
         if len(self.players) != Spades.NUM_PLAYERS:
             raise AttributeError("Players parameter must have length 4")
@@ -26,53 +93,67 @@ class Spades:
         self.nil_points = nil_points
         self.win_points = win_points
         self.max_rounds = max_rounds
+        self.result_detail = ResultDetail(result_detail)
+        self.early_termination = EarlyTermination(early_termination)
+        self.lead_rounds = lead_rounds
+        self.time_budget = time_budget
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.dealer = Dealer(self.rng, bank=deal_bank, offset=deal_offset)
 
         self.dealer_player = 0
         self.starting_player = 1
-        self.bids = list()  # list of lists of bids, split into rounds
-        self.tricks = np.ndarray((0, Hand.HAND_LEN, 1, Spades.NUM_PLAYERS))  # tricks of shape (1, 4) grouped into rounds
-        self.cards_played = list()  # list of lists of lists of cards, split into rounds then turns
-        self.scores = np.zeros((1, 1, 2))  # running scores of shape (1, 2) grouped into rounds
         self.spades_broken = False
 
+        # history buffers are preallocated for the longest possible game (max_rounds + 1 rounds) and filled in place;
+        # only the first num_rounds rounds are valid
+        self.num_rounds = 0
+        self.bids = np.full((max_rounds + 1, Spades.NUM_PLAYERS), -1, dtype=np.int8)  # bid values by player ID
+        self.tricks = np.full((max_rounds + 1, Hand.HAND_LEN), -1, dtype=np.int8)  # player ID that won each trick
+        self.cards_played = np.full((max_rounds + 1, Hand.HAND_LEN, Spades.NUM_PLAYERS), -1, dtype=np.int8)  # card values by player ID
+        self.scores = np.zeros((max_rounds + 2, 1, 2))  # running scores of shape (1, 2) grouped into rounds, starting from 0
+
     def deal(self):
-        player_hands = [Hand(), Hand(), Hand(), Hand()]
-        deck_cards = list(range(Card.CARD_LEN))
-        for _ in range(Hand.HAND_LEN):
-            for player in range(Spades.NUM_PLAYERS):
-                card_index = np.random.randint(0, len(deck_cards))
-                card = deck_cards[card_index]
-                player_hands[player].deal(Spades.CARD_BANK[card])
-                deck_cards.pop(card_index)
-        for i, player in enumerate(self.players):
-            player.deal(player_hands[i], i)
+        for i, (player, hand_values) in enumerate(zip(self.players, self.dealer.next_deal().tolist())):
+            player.deal(Hand.from_cards([Spades.CARD_BANK[value] for value in hand_values]), i)
 
     def bid(self):
         bid_state = [BLANK_BID] * Spades.NUM_PLAYERS
         player_order = self.players[self.starting_player:] + self.players[:self.starting_player]
-        for i, player in enumerate(player_order):
-            bid_state[i] = player.get_bid(bid_state)
+        for player in player_order:
+            bid_state[player.player_id] = player.get_bid(bid_state)  # store bids in order of the player ID's
         return bid_state
 
+    def score_history(self):
+        """
+        Returns a view of the running scores of the rounds played so far, of shape (rounds + 1, 1, 2)
+        """
+        return self.scores[:self.num_rounds + 1]
+
     def turn(self, bids, previous_play):
+        """
+        Plays one trick and returns the player ID that won it and the cards played by player ID
+        """
         played_cards = [BLANK_CARD] * Spades.NUM_PLAYERS
         winning_card = BLANK_CARD
         winning_player = self.starting_player  # first card played is automatically "winning" before any other plays
-        trick = np.zeros((1, Spades.NUM_PLAYERS))  # set to one for the player that wins the trick
+        scores = self.score_history()
         player_order = self.players[self.starting_player:] + self.players[:self.starting_player]
         for i, player in enumerate(player_order):
             player_id = player.player_id  # store plays in order of the player ID's
-            new_card = player.get_play(i, bids, self.scores, previous_play, played_cards, self.starting_player, self.spades_broken)
+            legal_plays = player.hand.legal_plays(self.spades_broken, get_first_card(played_cards, i, self.starting_player))
+            new_card = player.get_play(i, bids, scores, previous_play, played_cards, self.starting_player, self.spades_broken, legal_plays)
 
             if player.hand.has_card(new_card):
                 raise AttributeError(f"Card played by player id {player_id} is still in their hand")
-            if not new_card.is_valid_play(player.hand, self.spades_broken, get_first_card(played_cards, i, self.starting_player)):
+            if not new_card.bit & legal_plays:
                 raise ValueError(f"Card played by player id {player_id} is invalid")
 
             if new_card.suit() == Suits['SPADES'] and not self.spades_broken:
                 self.spades_broken = True
 
-            logger.debug('Card played', player=player_id, card=new_card, hand=player.hand, player_type=type(player))
+            if logger.debug_enabled:
+                logger.debug('Card played', player=player_id, card=new_card, hand=player.hand, player_type=type(player))
 
             if player_id == self.starting_player:
                 winning_card = new_card
@@ -81,42 +162,43 @@ class Spades:
                     winning_player = player_id
             played_cards[player_id] = new_card
 
-        trick[0, winning_player] = 1
-        logger.debug(f'Trick won', winner=winning_player, card=winning_card)
-        logger.debug('')
-        return trick, played_cards
+        if logger.debug_enabled:
+            logger.debug('Trick won', winner=winning_player, card=winning_card)
+            logger.debug('')
+        return winning_player, played_cards
 
     def round(self):
         self.deal()
         self.starting_player = (self.dealer_player + 1) % Spades.NUM_PLAYERS
         self.spades_broken = False
         round_bids = self.bid()
-        round_tricks = np.zeros((0, 1, Spades.NUM_PLAYERS))
-        round_cards = list()
-        round_score = self.scores[-1].copy().reshape((1, 2))
+        round_tricks = self.tricks[self.num_rounds]
+        round_cards = self.cards_played[self.num_rounds]
+        player_tricks = [0] * Spades.NUM_PLAYERS
+        round_score = self.scores[self.num_rounds + 1, 0]
+        round_score[:] = self.scores[self.num_rounds, 0]
         # initialize turn state for first turn
-        turn_tricks = np.zeros((1, Spades.NUM_PLAYERS))
-        turn_cards = [BLANK_CARD] * Spades.NUM_PLAYERS
+        turn_cards = BLANK_TRICK
 
         for turn in range(Hand.HAND_LEN):
-            logger.debug('Starting turn', turn=turn)
-            turn_tricks, turn_cards = self.turn(round_bids, turn_cards)  # feed in bid and previous turn info
-            round_tricks = np.concatenate((round_tricks, turn_tricks.reshape((1, 1, Spades.NUM_PLAYERS))))
-            round_cards.append(turn_cards)
-
-            winner = get_first_one_2d(turn_tricks, 0)
+            if logger.debug_enabled:
+                logger.debug('Starting turn', turn=turn)
+            winner, turn_cards = self.turn(round_bids, turn_cards)  # feed in bid and previous turn info
+            round_tricks[turn] = winner
+            round_cards[turn] = [card.value for card in turn_cards]
+            player_tricks[winner] += 1
             self.starting_player = winner
         
         for team in range(2):
             team_score = 0
             team_bags = 0
-            prev_score = self.scores[-1, 0, team]
+            prev_score = self.scores[self.num_rounds, 0, team]
             prev_bags = prev_score % 10
             p1_bid = round_bids[team].value
             p2_bid = round_bids[team + 2].value
             team_bid = p1_bid + p2_bid
-            p1_tricks = np.sum(round_tricks[:, 0, team])
-            p2_tricks = np.sum(round_tricks[:, 0, team + 2])
+            p1_tricks = player_tricks[team]
+            p2_tricks = player_tricks[team + 2]
             team_tricks = p1_tricks + p2_tricks
             # account for null bids
             if p1_bid == 0:
@@ -144,13 +226,11 @@ class Spades:
             if prev_bags + team_bags >= 10:
                 team_score -= 100
 
-            round_score[0, team] += team_score
+            round_score[team] += team_score
 
         # update game state
-        self.bids.append(round_bids)
-        self.scores = np.concatenate((self.scores, round_score.reshape((1, 1, 2))))
-        self.tricks = np.concatenate((self.tricks, round_tricks.reshape((1, Hand.HAND_LEN, 1, Spades.NUM_PLAYERS))))
-        self.cards_played.append(round_cards)
+        self.bids[self.num_rounds] = [bid.value for bid in round_bids]
+        self.num_rounds += 1
         self.dealer_player = (self.dealer_player + 1) % Spades.NUM_PLAYERS
 
     def game(self):
@@ -165,64 +245,225 @@ class Spades:
 
         round = 0
         exceeded_rounds = False
+        ended_early = False
+        start = time.perf_counter()
         # game continues until score difference is > 500 or max score is > 500
-        while np.max(self.scores[-1]) - np.min(self.scores[-1]) < self.win_points and np.max(self.scores[-1]) < self.win_points:
+        final_score = self.scores[0, 0]
+        while not self.is_won(final_score):
             self.round()
+            final_score = self.scores[self.num_rounds, 0]
             round += 1
             if round > self.max_rounds:
                 # print('Exceeded max rounds')
                 exceeded_rounds = True
                 break
-        logger.debug(f'Game finished', rounds=round, final_score=self.scores[-1])
+            if self.is_won(final_score):
+                break
+            if decided_early(self.early_termination, round, final_score, self.max_rounds, self.lead_rounds, self.nil_points):
+                ended_early = True
+                break
+            if out_of_time(start, self.time_budget):
+                ended_early = True
+                exceeded_rounds = final_score[0] == final_score[1]  # a tied game out of time has no winner
+                break
+        if logger.debug_enabled:
+            logger.debug('Game finished', rounds=round, final_score=final_score, ended_early=ended_early)
 
         results = dict()
         if exceeded_rounds:
             results['winning_players'] = None
         else:
-            winning_team = np.argmax(self.scores[-1])
+            winning_team = int(np.argmax(final_score))
             results['winning_players'] = [winning_team, winning_team + 2]
-        results['scores'] = np.copy(self.scores)
-        results['bids'] = self.bids
-        results['tricks'] = self.tricks
-        results['cards_played'] = self.cards_played
-        results['rounds'] = round
+        if self.result_detail >= ResultDetail.SUMMARY:
+            results['final_scores'] = final_score.astype(np.int32)
+            results['rounds'] = round
+            results['ended_early'] = ended_early
+            results['seed'] = self.seed
+        if self.result_detail >= ResultDetail.FULL:
+            results.update(self.packed_history())
         return results
 
+    def is_won(self, score):
+        """
+        Returns whether a team has won with the given (2,) team scores
+        """
+        return max(score) - min(score) >= self.win_points or max(score) >= self.win_points
+
+    def packed_history(self):
+        """
+        Returns the game history as compact integer arrays:
+        scores (rounds + 1, 2) running team scores starting from 0, bids (rounds, 4) bid values by player ID,
+        tricks (rounds, 13) winning player ID of each trick and cards_played (rounds, 13, 4) card values by player ID
+        """
+        return dict(
+            scores=self.score_history().reshape((self.num_rounds + 1, 2)).astype(np.int32),
+            bids=self.bids[:self.num_rounds].copy(),
+            tricks=self.tricks[:self.num_rounds].copy(),
+            cards_played=self.cards_played[:self.num_rounds].copy(),
+        )
+
 
-def multiprocess_spades_game(queue, pid, players, **kwargs):
+def pooled_spades_game(task):
     """
-    Plays one spades game and puts the results into the given queue.
-    Meant to use with multiprocessing to parallelize games.
+    Plays one spades game described by a (pid, players, kwargs) task and returns the results.
+    Meant to be mapped over a GamePool.
     """
+    pid, players, kwargs = task
     spades_game = Spades(players, **kwargs)
     results = spades_game.game()
     results['pid'] = pid
-    queue.put(results)
-    logger.debug('done with process', pid=pid)
+    return results
+
+
+def swap_teams(players):
+    """
+    Returns the players reseated so that each team sits in the other team's seats
+    """
+    return [players[1], players[0], players[3], players[2]]
+
+
+def duplicate_spades_game(task, record=None):
+    """
+    Plays the deals of one seed twice, the second time with the teams swapped into each other's seats,
+    so that both teams hold the same cards. Meant to be mapped over a GamePool.
+    Returns the pid, the score margin of the players[0] and players[2] team in each game and each team's wins
+    If record is given, both games are played with ResultDetail.FULL and record is called with the results of each
+    """
+    pid, players, kwargs = task
+    seed = as_seed_sequence(kwargs.get('seed'))  # both games must be dealt from the same seed
+    kwargs = dict(kwargs, seed=seed, result_detail=ResultDetail.FULL if record is not None else ResultDetail.SUMMARY)
+    first = Spades(players, **kwargs).game()
+    second = Spades(swap_teams(players), **kwargs).game()
+    if record is not None:
+        record(first)
+        record(second)
+
+    team_wins = [0, 0]
+    if first['winning_players'] is not None:
+        team_wins[first['winning_players'][0]] += 1
+    if second['winning_players'] is not None:
+        team_wins[1 - second['winning_players'][0]] += 1
+    margins = [int(first['final_scores'][0] - first['final_scores'][1]), int(second['final_scores'][1] - second['final_scores'][0])]
+    return dict(pid=pid, margins=margins, team_wins=team_wins)
+
+
+def duplicate_variance_reduction(margins):
+    """
+    Takes the (n, 2) score margins of n duplicate pairs and returns the fraction of the variance
+    of a two game margin that duplicate dealing removed, compared to two independently dealt games
+    """
+    margins = np.asarray(margins, dtype=float)
+    independent_variance = np.var(margins[:, 0]) + np.var(margins[:, 1])
+    if independent_variance == 0:
+        return 0.0
+    return float(1 - np.var(margins.sum(axis=1)) / independent_variance)
+
+
+def init_game_worker(seed_queue, initializer=None, initargs=()):
+    """
+    Seeds a GamePool worker from the next seed in the queue, then runs the pool's own initializer
+    """
+    np.random.seed(seed_queue.get().generate_state(4))
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def timed_task(task_fn, task):
+    """
+    Runs task_fn on the task and returns the time it took along with its results
+    """
+    start = time.perf_counter()
+    results = task_fn(task)
+    return time.perf_counter() - start, results
+
+
+class GamePool:
+    """
+    A long-lived pool of game worker processes.
+    Games are streamed to the workers as tasks and the results are yielded in the order they finish,
+    so one slow game never stalls the other cores.
+    busy_time adds up the time the workers spent on tasks, for measuring their utilization.
+    """
+
+    def __init__(self, core_count: int = 4, seed=None, initializer=None, initargs=()):
+        """
+        Each worker's global NumPy RNG is seeded from its own child of seed, so forked workers never share a stream
+        """
+        self.core_count = core_count
+        seed_queue = multiprocessing.SimpleQueue()
+        for worker_seed in as_seed_sequence(seed).spawn(core_count):
+            seed_queue.put(worker_seed)
+        self.pool = multiprocessing.Pool(core_count, initializer=init_game_worker, initargs=(seed_queue, initializer, initargs))
+        self.games_played = 0
+        self.busy_time = 0.0
+
+    def play(self, tasks, task_fn=pooled_spades_game, chunksize: int = 1):
+        """
+        Starts streaming tasks to the workers right away,
+        and returns an iterator that yields each result as soon as it is finished
+        """
+        return self.collect(self.pool.imap_unordered(functools.partial(timed_task, task_fn), tasks, chunksize))
+
+    def collect(self, timed_results):
+        for task_time, results in timed_results:
+            self.games_played += 1
+            self.busy_time += task_time
+            yield results
+
+    def utilization(self, busy_time: float, wall_time: float):
+        """
+        Returns the fraction of wall_time that the workers spent busy, given the busy_time they accumulated in it
+        """
+        return busy_time / (wall_time * self.core_count)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+            self.pool.join()
+
+
+def game_tasks(players, num_games, game_seed, pid=None, deal_bank=None, **kwargs):
+    """
+    Returns the tasks of num_games games between the players, for pooled_spades_game or duplicate_spades_game
+    Each game is seeded with its own child of game_seed, and its 'pid' is its offset (4 * game number) unless a pid is given
+    If a deal_bank file path is given, the games are dealt from evenly spaced offsets into it
+    """
+    bank_size = len(load_deal_bank(deal_bank)) if deal_bank is not None else 0
+    return ((game_num * 4 if pid is None else pid, players,
+             dict(kwargs, seed=task_seed, deal_bank=deal_bank, deal_offset=game_num * bank_size // num_games))
+            for game_num, task_seed in enumerate(game_seed.spawn(num_games)))
 
 
-def play_n_games(players, num_games, *args, core_count=4, **kwargs):
+def play_n_games(players, num_games, *args, core_count=4, pool=None, result_detail=ResultDetail.WINNER, seed=None, deal_bank=None,
+                 duplicate=False, **kwargs):
     """
     Plays N games with the given players and returns the results in a Queue
+    If no GamePool is given, a temporary one with core_count workers is used
+    result_detail sets how much of each game is sent back from the workers (see ResultDetail)
+    Every game gets its own child of seed, so the whole set of games is reproducible from one seed
+    If a deal_bank file path is given, the games are dealt from evenly spaced offsets into it,
+    so that different players can be evaluated on the exact same deals
+    If duplicate is set, each game is a duplicate pair and returns the results of duplicate_spades_game instead
     """
-    mp_queue = multiprocessing.Queue()
+    task_fn = duplicate_spades_game if duplicate else pooled_spades_game
     compiled_results = queue.Queue()
-    jobs = []
-    for game_num in range(num_games):
-        agent_offset = game_num * 4
-        #! Uncomment below and comment process stuff to disable multiprocessing
-        # spades_game = Spades(players, max_rounds=20)
-        # result = spades_game.game()
-        # result['pid'] = agent_offset
-        # compiled_results.put(result)
-        process = multiprocessing.Process(target=multiprocess_spades_game, args=(mp_queue, agent_offset, players), kwargs=kwargs)
-        jobs.append(process)
-        process.start()
-
-        # wait for core_count processes at a time since only that many can run simultaneously
-        if len(jobs) == core_count or len(jobs) == num_games:
-            [compiled_results.put(mp_queue.get()) for process in jobs]
-            for process in jobs:
-                process.join()
-            jobs.clear()
+    worker_seed, game_seed = as_seed_sequence(seed).spawn(2)
+    tasks = game_tasks(players, num_games, game_seed, deal_bank=deal_bank, result_detail=result_detail, **kwargs)
+    if pool is None:
+        with GamePool(core_count, seed=worker_seed) as pool:
+            for results in pool.play(tasks, task_fn):
+                compiled_results.put(results)
+    else:
+        for results in pool.play(tasks, task_fn):
+            compiled_results.put(results)
     return compiled_results
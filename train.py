@@ -1,20 +1,25 @@
 import cProfile
 import pstats
 import os
+import logging
 from fire import Fire
 
 from ai_agents.genetic import ConstantWeightsGenetic
+from ai_agents.islands import train_islands
+from util import set_log_level
 
 
-def genetic_training(experiment_name, **kwargs):
-    ConstantWeightsGenetic.train(output_folder=f'output_{experiment_name}', **kwargs)
+def genetic_training(experiment_name, islands=0, **kwargs):
+    if islands:
+        train_islands(islands, output_folder=f'output_{experiment_name}', **kwargs)
+    else:
+        ConstantWeightsGenetic.train(output_folder=f'output_{experiment_name}', **kwargs)
 
 
 def main(name, profile=False, debug=False, **kwargs):
     if debug:
-        os.environ.update(DEBUG="1")
-    else:
-        os.environ.pop('DEBUG', None)
+        os.environ.update(DEBUG="1")  # inherited by the game workers
+        set_log_level(logging.DEBUG)
 
     if profile:
         with cProfile.Profile() as pr:
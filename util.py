@@ -4,11 +4,79 @@ import logging
 import numpy as np
 
 
-structlog.configure(
-    wrapper_class=structlog.make_filtering_bound_logger(logging.DEBUG if bool(os.getenv('DEBUG')) else logging.INFO)
-)
+LOG_SUBSYSTEMS = ('engine', 'training', 'analysis')
 
-logger = structlog.get_logger()
+
+def default_log_level(subsystem):
+    """
+    Returns the starting log level of a subsystem, read from the LOG_LEVEL_<SUBSYSTEM> environment variable
+    (e.g. LOG_LEVEL_ENGINE=DEBUG), then from the DEBUG environment variable for every subsystem
+    """
+    level_name = os.getenv(f'LOG_LEVEL_{subsystem.upper()}')
+    if level_name:
+        return logging.getLevelName(level_name.upper())
+    return logging.DEBUG if bool(os.getenv('DEBUG')) else logging.INFO
+
+
+class SubsystemLogger:
+    """
+    A structlog logger for one subsystem with its own level.
+    Hot paths check debug_enabled before logging, so a disabled debug call costs one attribute lookup
+    and never builds its arguments:
+        if logger.debug_enabled:
+            logger.debug('Card played', hand=hand)
+    """
+
+    def __init__(self, subsystem):
+        self.subsystem = subsystem
+        self.set_level(default_log_level(subsystem))
+
+    def set_level(self, level):
+        self.level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+        self.debug_enabled = self.level <= logging.DEBUG
+        bound_logger = structlog.wrap_logger(None, wrapper_class=structlog.make_filtering_bound_logger(self.level), subsystem=self.subsystem)
+        self.debug = bound_logger.debug
+        self.info = bound_logger.info
+        self.warning = bound_logger.warning
+        self.error = bound_logger.error
+
+
+LOGGERS = {subsystem: SubsystemLogger(subsystem) for subsystem in LOG_SUBSYSTEMS}
+
+
+def get_logger(subsystem):
+    """
+    Returns the shared logger of a subsystem (engine, training or analysis)
+    """
+    return LOGGERS[subsystem]
+
+
+def set_log_level(level, subsystem=None):
+    """
+    Sets the log level of one subsystem, or of all of them if no subsystem is given
+    """
+    for name in LOG_SUBSYSTEMS if subsystem is None else [subsystem]:
+        LOGGERS[name].set_level(level)
+
+
+def as_seed_sequence(seed=None):
+    """
+    Returns seed as a np.random.SeedSequence, drawing fresh entropy if seed is None
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def complete_records(path, dtype):
+    """
+    Returns every whole record of the structured dtype in the file at path as a read-only memory-mapped array;
+    a partially written last record is ignored
+    """
+    num_records = os.path.getsize(path) // dtype.itemsize if os.path.exists(path) else 0
+    if num_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(num_records,))
 
 
 def get_first_one_1d(array):